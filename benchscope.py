@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# benchscope.py
+# where does the time go in TektronixScope.acquire? runs against the simulated TDS 2024 in testscope.py
+# and writes the numbers as JSON, so the hot paths can be compared between releases:
+#
+#   python benchscope.py                       # instant link, i.e. host CPU cost only
+#   python benchscope.py --link serial -n 5    # with the 9600 baud link modelled
+#
+# reports full-acquire cycles/sec for 1-4 channels, latency histograms for query, cmd, query_float and
+# wfmpreQ, the measurement reads on their own (IMMed, slots, host), curve decode MB/s, and ScopeDisplay
+# render time.
+
+import sys
+import json
+import datetime
+import platform
+from time import time
+from argparse import ArgumentParser
+
+import matplotlib
+matplotlib.use('Agg')  # we only draw offscreen
+import matplotlib.pyplot as pyplot
+import numpy
+from numpy import array, histogram, logspace, log10, percentile
+
+from tekscope import decodeCurve
+from testscope import DummyScope
+from plotter import ScopeDisplay
+
+mT = ('FREQ', 'PK2P', 'RISE', 'MEAN')
+
+class BenchScope(DummyScope):
+    # free running, acquire() reads whatever is on screen instead of waiting for a single sequence
+    # the simulator has no display to refresh the measurement slots, so slot reads aren't held back either:
+    # the numbers are the link and host cost, not the 1/2 second a real TDS 2024 needs
+    def __init__(self, **kwD):
+        super(BenchScope, self).__init__(**kwD)
+        self._measCtl.slotSettle = 0
+
+    def prepare(self):
+        self.cmd('acquire:state on')
+
+def timeit(func, n, warmup=1):
+    # wall time of n calls, seconds each, after warmup untimed ones (slot setup, preamble cache, ...)
+    for i in range(warmup):
+        func()
+    tL = []
+    for i in range(n):
+        t0 = time()
+        func()
+        tL.append(time()-t0)
+    return array(tL)
+
+def latencyStats(tA):
+    # summary and a log spaced histogram, in seconds
+    lo, hi = max(tA.min(), 1e-7), max(tA.max(), 2e-7)
+    cnt, edges = histogram(tA, bins=logspace(log10(lo), log10(hi)+1e-9, 16))
+    return {'n': len(tA), 'mean': tA.mean(), 'min': tA.min(), 'max': tA.max(),
+            'p50': percentile(tA, 50), 'p90': percentile(tA, 90), 'p99': percentile(tA, 99),
+            'hist': {'edges': edges.tolist(), 'counts': cnt.tolist()}}
+
+def benchAcquire(scope, n):
+    resD = {}
+    for nch in (1, 2, 3, 4):
+        chmD = dict( (ch, mT) for ch in range(1, nch+1) )
+        tA = timeit(lambda: scope.acquire(chmD), n)
+        resD['%dch'%nch] = {'cyclesPerSec': 1.0/tA.mean(), 'latency': latencyStats(tA)}
+    return resD
+
+def benchLatency(scope, n):
+    chan = scope.getChannel(1)
+    chan.invalidate()
+    def wfmpreQ():
+        chan.wfmpreQ()
+    return {'query': latencyStats(timeit(lambda: scope.query('CH1:SCA?'), n)),
+            'cmd': latencyStats(timeit(lambda: scope.cmd('CH1:POS 0'), n)),
+            'query_float': latencyStats(timeit(lambda: scope.query_float('hor:mai:sca?'), n)),
+            'wfmpreQ': latencyStats(timeit(wfmpreQ, n))}
+
+def benchMeasure(scope, n):
+    # the measurement read of a 4 channel acquire() on its own, each way it can be done
+    chmD = dict( (ch, mT) for ch in (1, 2, 3, 4) )
+    scope.acquire(chmD)
+    wfmD = dict( (ch, scope.getChannel(ch).wfm) for ch in chmD )
+    return {'immed': latencyStats(timeit(lambda: scope.acqMeas(chmD, immed=True), n)),
+            'slots': latencyStats(timeit(lambda: scope.acqMeas(chmD), n)),
+            'host': latencyStats(timeit(lambda: scope.hostMeasure(chmD, wfmD), n))}
+
+def benchDecode(scope, n):
+    # decodeCurve on its own, and the whole Channel.acquire it sits in
+    resD = {}
+    chan = scope.getChannel(1)
+    chan.getVerticalSetting()
+    for width in (1, 2):
+        scope.cmd('DATA:WIDTH %d'%width)
+        chan.acquire(True)
+        block = scope.sim.curve()
+        block = block[block.index('#')+2+int(block[block.index('#')+1]):]
+        tA = timeit(lambda: decodeCurve(block, chan.wfmD, chan.voltsdiv), 10*n)
+        tB = timeit(lambda: chan.acquire(True), n)
+        resD['BYT_NR%d'%width] = {'bytes': len(block),
+                                  'decodeMBps': len(block)/tA.mean()/1e6,
+                                  'acquireMBps': len(block)/tB.mean()/1e6,
+                                  'decode': latencyStats(tA), 'acquire': latencyStats(tB)}
+    scope.cmd('DATA:WIDTH 1')
+    return resD
+
+def benchRender(scope, n):
+    chNL = (1, 2, 3, 4)
+    scope.acquire( dict( (ch, mT) for ch in chNL ) )
+    def render():
+        disp = ScopeDisplay(scope, idStr='bench', disp=False, save=False)
+        for ch in chNL:
+            disp.plotChannel(ch)
+        disp.plotAll(chNL)
+        for fig in disp.figL:
+            fig.canvas.draw()
+        pyplot.close('all')
+    return {'render': latencyStats(timeit(render, n))}
+
+def run(link=None, n=20):
+    scope = BenchScope(link=link)
+    resD = {'meta': {'date': datetime.datetime.now().isoformat(), 'link': link, 'n': n,
+                     'python': platform.python_version(), 'numpy': numpy.__version__,
+                     'matplotlib': matplotlib.__version__}}
+    resD['acquire'] = benchAcquire(scope, n)
+    resD['latency'] = benchLatency(scope, n)
+    resD['measure'] = benchMeasure(scope, n)
+    resD['decode'] = benchDecode(scope, n)
+    resD['display'] = benchRender(scope, max(n//4, 1))
+    return resD
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='acquisition benchmarks against the simulated TDS 2024')
+    parser.add_argument('--link', default=None, help='serial, serial19200 or usb, default: instant')
+    parser.add_argument('-n', type=int, default=20, help='repetitions per measurement')
+    parser.add_argument('-o', '--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    resD = run(args.link, args.n)
+    with open(args.output, 'w') as fp:
+        json.dump(resD, fp, indent=1, sort_keys=True)
+    for nch, d in sorted(resD['acquire'].items()):
+        print 'acquire %s: %8.1f cycles/s'%(nch, d['cyclesPerSec'])
+    for key, d in sorted(resD['latency'].items()):
+        print '%-12s p50 %8.3f ms  p99 %8.3f ms'%(key, 1e3*d['p50'], 1e3*d['p99'])
+    for key, d in sorted(resD['measure'].items()):
+        print 'measure %-6s p50 %8.3f ms  p99 %8.3f ms'%(key, 1e3*d['p50'], 1e3*d['p99'])
+    for key, d in sorted(resD['decode'].items()):
+        print 'decode %s: %8.1f MB/s (acquire %.3g MB/s)'%(key, d['decodeMBps'], d['acquireMBps'])
+    print 'render: %.1f ms'%(1e3*resD['display']['render']['mean'])
+    print 'written to', args.output
+    sys.exit(0)
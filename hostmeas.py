@@ -0,0 +1,157 @@
+# hostmeas.py
+# the TDS 2024's automatic measurements, worked out on the host from acquired traces instead of asking the scope
+#
+# all of Measurement.mtypeT, vectorized over a batch of traces stacked as the rows of a 2D array, so one call
+# covers every channel (or every capture) at once. reference levels are the scope's, on the record's min/max:
+#   50% mid level for PERI, FREQ, CRMS, PWID, NWID, PHAS; 10%/90% for RISE and FALL
+#   an edge through mid only counts once the signal has gone from one side of the hysteresis band, mid +- 10%
+#   of pk2pk, to the other, so noise wiggling around mid doesn't make edges; it is timed at its last mid crossing
+#   RISE/FALL: from the last crossing of the start level before the first complete edge
+#   CRMS: over the first complete period, the whole record if there is none
+#   PHAS: against a reference trace, degrees the rising edge lags the reference's, in (-180, 180]
+# undefined results (no edge, flat trace, no reference) are NaN, where the scope would say 9.9E37
+
+from numpy import arange, asarray, atleast_2d, broadcast_to, cumsum, float64, isnan, nan, sqrt, where, zeros, int8
+from numpy import maximum
+
+hysteresis = 0.1  # half width of the band around mid, fraction of pk2pk
+
+typT = ('FREQ', 'MEAN', 'PERI', 'PHAS', 'PK2P', 'CRMS', 'MINI', 'MAXI', 'RISE', 'FALL', 'PWID', 'NWID')
+
+def _crossMask(V, level, rising):
+    # (n, p-1) True at i where a row crosses level between samples i and i+1
+    lev = level[:, None]
+    if rising:
+        return (V[:, :-1] < lev) & (V[:, 1:] >= lev)
+    return (V[:, :-1] > lev) & (V[:, 1:] <= lev)
+
+def _firstCol(mask, after=None):
+    # per row the first True column >= after (-1: none)
+    if after is not None:
+        mask = mask & (arange(mask.shape[1]) >= after[:, None])
+    return where(mask.any(1), mask.argmax(1), -1)
+
+def _lastCol(mask, upto):
+    # per row the last True column <= upto (-1: none)
+    mask = mask & (arange(mask.shape[1]) <= upto[:, None])
+    return where(mask.any(1), mask.shape[1]-1 - mask[:, ::-1].argmax(1), -1)
+
+def _frac(V, col, level):
+    # fractional sample index of the crossing in column col, NaN where col is -1
+    rows = arange(len(V))
+    c = where(col < 0, 0, col)
+    v0, v1 = V[rows, c], V[rows, c+1]
+    moved = v1 != v0
+    t = c + (level - v0)/where(moved, v1 - v0, 1.0)
+    return where((col >= 0) & moved, t, nan)
+
+def _bandState(V, lo, hi):
+    # per sample which side of the band lo..hi a row was on last: 1 above, -1 below, 0 not yet outside it
+    side = (V >= hi[:, None]).astype(int8) - (V <= lo[:, None])
+    last = where(side != 0, arange(V.shape[1]), 0)
+    maximum.accumulate(last, axis=1, out=last)
+    return side[arange(len(V))[:, None], last]
+
+def _edges(V, level, band, rising):
+    # first and second edge through level +- band: (edge mask, first, second edge column, the fractional
+    # sample indices of their last level crossings). an edge column is the last sample before the far side
+    state = _bandState(V, level-band, level+band)
+    before, after = (-1, 1) if rising else (1, -1)
+    mask = (state[:, :-1] == before) & (state[:, 1:] == after)
+    e0 = _firstCol(mask)
+    e1 = where(e0 >= 0, _firstCol(mask, e0+1), -1)
+    return mask, e0, e1, _edgeTime(V, level, rising, e0), _edgeTime(V, level, rising, e1)
+
+def _edgeTime(V, level, rising, e):
+    # fractional sample index of the last crossing of level at or before edge column e (NaN where e is -1)
+    return _frac(V, _lastCol(_crossMask(V, level, rising), e), level)
+
+def _transition(V, start, end, rising):
+    # samples from the last start level crossing before the first complete edge to its end level crossing
+    sMask, eMask = _crossMask(V, start, rising), _crossMask(V, end, rising)
+    s0 = _firstCol(sMask)
+    e = where(s0 >= 0, _firstCol(eMask, where(s0 < 0, 0, s0)), -1)
+    s = where(e >= 0, _lastCol(sMask, e), -1)
+    return _frac(V, e, end) - _frac(V, s, start)
+
+def measureBatch(V, xincr, typL=typT, refV=None):
+    """
+    {typ: array of one value per row of V} for the measurement types in typL.
+    V: volts, (traces, points) or a single trace; xincr: seconds per point, scalar or one per trace;
+    refV: reference trace(s) for PHAS, broadcast against V.
+    """
+    V = atleast_2d(asarray(V, dtype=float64))
+    n = len(V)
+    xincr = broadcast_to(asarray(xincr, dtype=float64), (n,))
+    typL = [typ.upper() for typ in typL]
+    for typ in typL:
+        if typ not in typT: raise ValueError('Not a measurement type: %s'%typ)
+
+    vmin, vmax = V.min(1), V.max(1)
+    pk2pk = vmax - vmin
+    flat = pk2pk == 0
+    mid = vmin + 0.5*pk2pk
+    band = hysteresis*pk2pk
+    resD = {}
+    cacheD = {}
+    def edges(rising):
+        if rising not in cacheD: cacheD[rising] = _edges(V, mid, band, rising)
+        return cacheD[rising]
+    def period():
+        # first two crossings of the mid level, rising ones if there are two, as (start, end) indices
+        up, down = edges(True), edges(False)
+        useUp = up[2] >= 0
+        return where(useUp, up[3], down[3]), where(useUp, up[4], down[4])
+
+    for typ in typL:
+        if typ == 'MEAN':
+            val = V.mean(1)
+        elif typ == 'PK2P':
+            val = pk2pk
+        elif typ == 'MINI':
+            val = vmin
+        elif typ == 'MAXI':
+            val = vmax
+        elif typ in ('PERI', 'FREQ'):
+            t0, t1 = period()
+            val = (t1 - t0)*xincr
+            if typ == 'FREQ': val = 1.0/val
+        elif typ == 'CRMS':
+            t0, t1 = period()
+            whole = sqrt((V*V).mean(1))  # no whole period: the RMS of the record
+            ok = ~isnan(t0) & ~isnan(t1)
+            a = where(ok, t0, 0).astype(int)
+            b = where(ok, t1, 1).astype(int)
+            sq = zeros((n, V.shape[1]+1))
+            cumsum(V*V, axis=1, out=sq[:, 1:])
+            rows = arange(n)
+            cyc = sqrt( (sq[rows, b] - sq[rows, a]) / where(b > a, b - a, 1) )
+            val = where(ok & (b > a), cyc, whole)
+        elif typ in ('RISE', 'FALL'):
+            lo, hi = vmin + 0.1*pk2pk, vmin + 0.9*pk2pk
+            if typ == 'RISE':
+                val = _transition(V, lo, hi, True)*xincr
+            else:
+                val = _transition(V, hi, lo, False)*xincr
+        elif typ in ('PWID', 'NWID'):
+            # from the first edge to the next one the other way
+            e0, t0 = edges(typ == 'PWID')[1], edges(typ == 'PWID')[3]
+            endMask = edges(typ != 'PWID')[0]
+            e1 = where(e0 >= 0, _firstCol(endMask, where(e0 < 0, 0, e0)+1), -1)
+            val = (_edgeTime(V, mid, typ != 'PWID', e1) - t0)*xincr
+        elif typ == 'PHAS':
+            if refV is None:
+                val = zeros(n) + nan
+            else:
+                R = broadcast_to(atleast_2d(asarray(refV, dtype=float64)), V.shape)
+                rmin, rmax = R.min(1), R.max(1)
+                rmid = rmin + 0.5*(rmax - rmin)
+                tr0, tr1 = _edges(R, rmid, hysteresis*(rmax - rmin), True)[3:]
+                lag = (edges(True)[3] - tr0)/(tr1 - tr0)*360.0
+                val = 180.0 - (180.0 - lag) % 360.0
+                val = where(rmax == rmin, nan, val)
+        val = asarray(val, dtype=float64)
+        if typ not in ('MEAN', 'PK2P', 'MINI', 'MAXI', 'CRMS'):
+            val = where(flat, nan, val)
+        resD[typ] = val
+    return resD
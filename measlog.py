@@ -0,0 +1,146 @@
+# measlog.py
+# high rate measurement logging for TektronixScope.measLoop: constant memory, cheap per sample
+#
+# values go into preallocated columns, one per (channel, type), in a ring of the last capacity samples with
+# their timestamps. count/mean/stddev are kept up to date by Welford updates, vectorized across the columns,
+# for the whole run and for each rolling window (adding the newest sample, removing the one that falls out).
+# min/max are running for the whole run and taken from the ring for windows, when asked for.
+# nothing is formatted until stats()/format() are called; undefined readings (9.9E37) count as missing
+
+from time import time
+from numpy import arange, empty, zeros, full, inf, nan, isnan, where, sqrt, fmin, fmax, float64
+
+from tekscope import Measurement, mNAN
+
+class _Welford(object):
+    # count, mean and sum of squared deviations for every column
+    def __init__(self, nCol):
+        self.n = zeros(nCol)
+        self.mean = zeros(nCol)
+        self.m2 = zeros(nCol)
+
+    def add(self, x, ok):
+        self.n += ok
+        d = where(ok, x - self.mean, 0.0)
+        self.mean += d/where(self.n > 0, self.n, 1)
+        self.m2 += d*where(ok, x - self.mean, 0.0)
+
+    def remove(self, x, ok):
+        self.n -= ok
+        left = self.n > 0
+        d = where(ok & left, x - self.mean, 0.0)
+        self.mean -= d/where(left, self.n, 1)
+        self.m2 -= d*where(ok & left, x - self.mean, 0.0)
+        self.mean[~left] = 0.0
+        self.m2[~left] = 0.0
+
+    def std(self):
+        # sample standard deviation, NaN below 2 samples
+        return where(self.n > 1, sqrt(abs(self.m2)/where(self.n > 1, self.n - 1, 1)), nan)
+
+class MeasLog(object):
+    """
+    Timestamped measurement values in columns keyed (chN, typ), e.g.
+
+        log = MeasLog([(1, 'FREQ'), (1, 'PK2P'), (2, 'MEAN')], capacity=100000, windowL=(10, 1000))
+        log.append({1: {'FREQ': 1.0e3, 'PK2P': 4.04}, 2: {'MEAN': 2.5}})
+        log.stats(1000)   # {(1, 'FREQ'): {'n': ..., 'mean': ..., 'std': ..., 'min': ..., 'max': ...}, ...}
+        print '\\n'.join(log.format(10))
+
+    windowL are rolling windows in samples (at most capacity), stats(None) is the whole run.
+    """
+    resync = 100000  # windowed Welford sums are recomputed from the ring this often, against drift
+
+    def __init__(self, keyL, capacity=100000, windowL=(100,)):
+        self.keyL = [ (chN, typ.upper()) for chN, typ in keyL ]
+        self._colD = dict( (key, i) for i, key in enumerate(self.keyL) )
+        for w in windowL:
+            if not 0 < w <= capacity: raise ValueError('Window of %s samples does not fit a %d sample log'%(w, capacity))
+        nCol = len(self.keyL)
+        self.capacity = capacity
+        self.windowL = tuple(windowL)
+        self.t = empty(capacity, dtype=float64)
+        self.vals = full((capacity, nCol), nan)
+        self.n = 0  # samples appended over the run, the ring holds the last capacity of them
+        self._all = _Welford(nCol)
+        self._min = full(nCol, nan)
+        self._max = full(nCol, nan)
+        self._winD = dict( (w, _Welford(nCol)) for w in self.windowL )
+        self._msmnt = Measurement(None)  # for its val_to_string
+
+    def __len__(self):
+        return min(self.n, self.capacity)
+
+    def append(self, valD, t=None):
+        # valD: {chN: {typ: val}} as TektronixScope.acqMeas returns it; columns not in valD are missing
+        row = self.vals[self.n % self.capacity]
+        # samples leaving the windows, taken out before the new one overwrites the slot (a window can be the
+        # whole ring)
+        for w, wf in self._winD.items():
+            if self.n >= w:
+                old = self.vals[(self.n - w) % self.capacity]
+                wf.remove(old, ~isnan(old))
+        row[:] = nan
+        for chN, tvD in valD.items():
+            for typ, val in tvD.items():
+                i = self._colD.get( (chN, typ.upper()) )
+                if i is not None and val != mNAN: row[i] = val
+        self.t[self.n % self.capacity] = time() if t is None else t
+        ok = ~isnan(row)
+        self._all.add(row, ok)
+        self._min = fmin(self._min, row)
+        self._max = fmax(self._max, row)
+        for wf in self._winD.values():
+            wf.add(row, ok)
+        self.n += 1
+        if self.n % self.resync == 0: self._resync()
+
+    def _resync(self):
+        for w, wf in self._winD.items():
+            win = self.window(w)[1]
+            ok = ~isnan(win)
+            wf.n = ok.sum(0).astype(float64)
+            wf.mean = where(wf.n > 0, where(ok, win, 0.0).sum(0)/where(wf.n > 0, wf.n, 1), 0.0)
+            wf.m2 = (where(ok, win - wf.mean, 0.0)**2).sum(0)
+
+    def window(self, w=None):
+        # (t, vals) of the last w samples (all that are held for None), oldest first; copies
+        n = len(self) if w is None else min(w, len(self))
+        idx = (self.n - n + arange(n)) % self.capacity
+        return self.t[idx], self.vals[idx]
+
+    def column(self, key, w=None):
+        # (t, values) of one (chN, typ) column
+        t, vals = self.window(w)
+        return t, vals[:, self._colD[(key[0], key[1].upper())]]
+
+    def stats(self, window=None):
+        # {key: {'n', 'mean', 'std', 'min', 'max'}} over a rolling window, or the whole run for None
+        if window is None:
+            wf, vmin, vmax = self._all, self._min, self._max
+        else:
+            wf = self._winD[window]
+            win = self.window(window)[1]
+            ok = ~isnan(win)
+            some = ok.any(0)
+            vmin = where(some, where(ok, win, inf).min(0), nan)
+            vmax = where(some, where(ok, win, -inf).max(0), nan)
+        std = wf.std()
+        return dict( (key, {'n': int(wf.n[i]), 'mean': wf.mean[i] if wf.n[i] else nan, 'std': std[i],
+                            'min': vmin[i], 'max': vmax[i]})
+                     for i, key in enumerate(self.keyL) )
+
+    def format(self, window=None):
+        # one display line per column: mean +- std [min .. max] n
+        fmt = self._msmnt.val_to_string
+        statD = self.stats(window)
+        lineL = []
+        for chN, typ in self.keyL:
+            st = statD[(chN, typ)]
+            if not st['n']:
+                lineL.append('CH%d %4s:  ** no data **'%(chN, typ))
+                continue
+            val = lambda v: fmt(v if v == v else mNAN, typ)[6:]
+            lineL.append('CH%d %s +- %s [%s .. %s] n %d'%(chN, fmt(st['mean'], typ), val(st['std']),
+                                                          val(st['min']).strip(), val(st['max']).strip(), st['n']))
+        return lineL
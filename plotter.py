@@ -1,22 +1,45 @@
-from matplotlib import rc, use
+from matplotlib import rc
 rc('text', usetex=False)
 rc('font', family='monospace')  # LOOKs like a scope  ;-)
+# the backend is the caller's pick (matplotlib.use() before importing us, or TektronixScope.display()),
+# TkAgg for the interactive annotate/save. others had trouble:
 # WXAgg: problems with draw below() .... use ginput() ???
 # GtkAgg: /usr/lib/python2.7/dist-packages/matplotlib/backends/backend_gtk.py:253:
 #         Warning: Source ID 5 was not found when attempting to remove it
 #  gobject.source_remove(self._idle_event_id)
-use("TkAgg")
 
-from matplotlib.pyplot import plot, axis, xlabel, ylabel, gca, grid, text, show, figure, xticks, title, rcParams, savefig
+from matplotlib.pyplot import plot, axis, xlabel, ylabel, gca, grid, text, show, figure, xticks, title, rcParams, savefig, fill_between, close
 try:
     rcParams['savefig.directory'] = None  # use default
 except KeyError:
     pass
 
-from numpy import arange
+import os
+from time import time
+from numpy import arange, empty, float64, asarray, atleast_2d, column_stack, minimum, maximum
+
+def envelope(Y, cols):
+    """
+    Min/max envelope of traces over cols equal runs of points, as a scope's peak detect display draws them, e.g.
+    one run per pixel column of the axes. Y: traces stacked as rows, or a single trace.
+    Returns (lo, hi, mid), lo and hi (traces, cols), mid the sample index at the middle of each run; a trace that
+    has no more points than cols comes back whole, lo == hi.
+    """
+    Y = atleast_2d(asarray(Y))
+    p = Y.shape[1]
+    if p <= cols:
+        return Y, Y, arange(p)
+    startA = (arange(cols)*p)//cols
+    endA = ((arange(cols)+1)*p)//cols
+    return minimum.reduceat(Y, startA, axis=1), maximum.reduceat(Y, startA, axis=1), (startA+endA-1)//2
+
+def peakLine(x, lo, hi):
+    # one trace's envelope as a single line: a vertical stroke min to max at every run, glitches and all
+    return x.repeat(2), column_stack((lo, hi)).ravel()
 
 class ScopeDisplay(object):
     colorD = {1:'yellow', 2: 'aqua', 3: 'purple', 4: 'darkgreen'} # approx channel colors
+    peakDetect = True  # traces with more points than the axes has pixel columns get drawn as min/max envelopes
 
     def __init__(self, instr, idStr, disp=False, save=True):
         self.instr=instr
@@ -28,13 +51,33 @@ class ScopeDisplay(object):
         if disp: self.display()
 
     def display(self):
-        chNL = [ ch for ch in range(1,5)  if self.instr.channelWasAcq(ch) ]
-        for ch in chNL:
-            self.plotChannel(ch, scopeView=False)
-        self.plotAll(chNL)
+        self.render()
         if self.save: self.annotate_plots()
         self.show()
 
+    def render(self, chNL=None, chAll=True):
+        # the figures display() shows: one per channel, and CHALL with them all on the scope's screen
+        chNL = chNL or [ ch for ch in range(1,5)  if self.instr.channelWasAcq(ch) ]
+        for ch in chNL:
+            self.plotChannel(ch, scopeView=False)
+        if chAll: self.plotAll(chNL)
+
+    def saveFigures(self, outDir='Traces', formats=('png',), annotL=()):
+        # headless annotate_plots(): annotL are (figure label or None for all, x, y, text) in data coordinates,
+        # every figure is written as outDir/<label>-<idStr>.<format> and closed; returns the paths
+        pathL = []
+        for fig in self.figL:
+            label = str(fig.get_label())
+            for figLabel, x, y, txt in annotL:
+                if figLabel in (None, label): fig.axes[0].text(x, y, txt)
+            for fmt in formats:
+                path = os.path.join(outDir, '%s-%s.%s'%(label, self.idStr, fmt))
+                fig.savefig(path)
+                pathL.append(path)
+            close(fig)
+        self.figL = []
+        return pathL
+
     def plotAll(self, chNL):
         f=figure('CHALL')
         self.figL.append(f)
@@ -106,10 +149,9 @@ class ScopeDisplay(object):
             self.figL.append(f)
             title(chan.wfmD['WFID'], size=10)
         
-        points=chan.points
-        x = 10.0*arange(points)/points
+        x = chan.divAxis()
         trace =  chan.trace_undisplaced if scopeView else  chan.trace
-        plot(x,trace, color=self.colorD[chN])
+        self.plotTrace(x, trace, color=self.colorD[chN])
 
         xlabel(self.instr.sweepStr, size=labelSz)
         theaxes = gca()
@@ -136,6 +178,42 @@ class ScopeDisplay(object):
 
         if showMeas: self.displayMeasurements((chN,) )
 
+    def pixelColumns(self, ax=None):
+        # width of the axes in pixels, at the figure's dpi
+        return max(int((ax or gca()).bbox.width), 1)
+
+    def plotTrace(self, x, trace, **kwargs):
+        # plot() for one trace, decimated to a min/max envelope per pixel column when that has fewer points
+        cols = self.pixelColumns()
+        if self.peakDetect and len(trace) > 2*cols:
+            lo, hi, mid = envelope(trace, cols)
+            x, trace = peakLine(x[mid], lo[0], hi[0])
+        return plot(x, trace, **kwargs)
+
+    def plotOverlay(self, chN, traces, x=None, scopeView=True, newfig=True, alpha=0.6):
+        """
+        Persistence view of many captures of channel chN: the band between the lowest and highest value any of
+        them had in each pixel column, and the last one drawn over it. traces: the captures stacked as rows,
+        in divisions for scopeView (e.g. [rec.wfm.divisions for rec in recL]) or volts; x defaults to the
+        channel's divAxis(). Costs one pass over the traces, drawing is the same for 10 or 10000 of them.
+        """
+        color = self.colorD[chN]
+        if newfig:
+            f=figure('CH%1d-persist'%chN)
+            self.figL.append(f)
+        Y = atleast_2d(asarray(traces))
+        if x is None: x = self.instr.getChannel(chN).divAxis()
+        lo, hi, mid = envelope(Y, self.pixelColumns() if self.peakDetect else Y.shape[1])
+        fill_between(x[mid], lo.min(0), hi.max(0), color=color, alpha=alpha, linewidth=0)
+        self.plotTrace(x, Y[-1], color=color)
+        theaxes = gca()
+        theaxes.set_xticklabels([])
+        xticks( arange(0,10,1) )
+        if scopeView:
+            axis([0,10,-4,4])
+            theaxes.set_yticklabels([])
+        grid(1)
+
     def onclick(self, event):
         ax = gca()
         fig = ax.get_figure()
@@ -167,6 +245,95 @@ class ScopeDisplay(object):
     def show(self):
         show()
 
+class LiveDisplay(object):
+    """
+    Live scope view: one figure whose channel lines and measurement texts are made once, then updated in place
+    (set_ydata into preallocated buffers) and blitted over a cached background as captures come in, e.g.
+
+        live = LiveDisplay(scope)
+        for recL in scope.sequence((1, 2)):
+            live.update( dict((rec.chN, rec.wfm) for rec in recL) )
+
+    Traces are drawn in screen divisions, as in ScopeDisplay's scopeView. A resize redraws everything once and
+    takes a new background.
+    """
+    colorD = ScopeDisplay.colorD
+
+    def __init__(self, instr, chNL=(1,2,3,4), label='LIVE'):
+        self.instr = instr
+        self.fig = figure(label)
+        self.ax = ax = self.fig.add_subplot(111)
+        ax.axis([0,10,-4,4])
+        ax.set_xticks( arange(0,10,1) )
+        ax.set_xticklabels([])
+        ax.set_yticklabels([])
+        ax.grid(1)
+        self.lineD = {}
+        self.textD = {}
+        self._yD = {}  # per channel y buffer, reused frame after frame
+        for i, chN in enumerate(chNL):
+            self.lineD[chN] = ax.plot([], [], color=self.colorD[chN], animated=True)[0]
+            self.textD[chN] = ax.text(0.1, -3.8+0.35*i, '', color=self.colorD[chN], backgroundcolor='silver',
+                                      size=6, family='monospace', animated=True)
+        self._bg = None
+        self.frames = 0
+        self._tL = []  # recent frame times, for fps()
+        self.fig.canvas.mpl_connect('draw_event', self._onDraw)
+        self.fig.canvas.draw()
+
+    def _onDraw(self, event):
+        # the figure got redrawn (first show, resize): new background under the animated artists
+        self._bg = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+
+    def _ydata(self, chN, wfm):
+        # screen divisions of a Waveform, into the channel's buffer
+        y = self._yD.get(chN)
+        if y is None or len(y) != len(wfm):
+            y = self._yD[chN] = empty(len(wfm), dtype=float64)
+            x = arange(wfm.start-1, wfm.start-1+len(wfm), dtype=float64)
+            x *= 10.0/self.instr.recordLength
+            self.lineD[chN].set_xdata(x)
+        return wfm.divisionsInto(y)
+
+    def update(self, wfmD, textD=None):
+        # wfmD: {chN: Waveform}, textD: {chN: measurement text}; channels not given keep what they show
+        for chN, wfm in wfmD.items():
+            self.lineD[chN].set_ydata(self._ydata(chN, wfm))
+        for chN, txt in (textD or {}).items():
+            self.textD[chN].set_text(txt)
+        self.blit()
+
+    def updateFromScope(self, chNL=None):
+        # the channels of the instrument's last acquire(), with their measurements
+        chNL = chNL or [ch for ch in self.lineD if self.instr.channelWasAcq(ch)]
+        chanL = [self.instr.getChannel(ch) for ch in chNL]
+        self.update( dict( (ch, chan.wfm) for ch, chan in zip(chNL, chanL) ),
+                     dict( (ch, ' '.join(chan.getMeasStrL())) for ch, chan in zip(chNL, chanL) ) )
+
+    def blit(self):
+        canvas = self.fig.canvas
+        if self._bg is None: canvas.draw()
+        canvas.restore_region(self._bg)
+        for artist in self.lineD.values() + self.textD.values():
+            self.ax.draw_artist(artist)
+        canvas.blit(self.ax.bbox)
+        canvas.flush_events()
+        self.frames += 1
+        self._tL = (self._tL + [time()])[-30:]
+
+    def fps(self):
+        # frames per second over the last 30
+        if len(self._tL) < 2: return 0.0
+        return (len(self._tL)-1)/(self._tL[-1]-self._tL[0])
+
+    def run(self, source):
+        # show every capture of source (lists of TraceRecords, or single ones, as stream()/sequence() yield)
+        self.fig.show()
+        for item in source:
+            recL = item if isinstance(item, list) else [item]
+            self.update( dict( (rec.chN, rec.wfm) for rec in recL ),
+                         dict( (rec.chN, ' '.join('%s %.4g'%kv for kv in rec.measD.items())) for rec in recL if rec.measD ) )
+
 if __name__ == '__main__':
     tag = raw_input('Enter: ')
     print tag
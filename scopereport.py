@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+# scopereport.py
+# headless rendering of many captures to image files, e.g. the end of shift report of a soak run:
+#
+#   python scopereport.py scope.dat -o Traces -f png svg       # every capture in the trace store
+#   python scopereport.py scope.dat --last 100 -j 8            # the last 100, on 8 processes
+#
+# each capture gets ScopeDisplay's figures (one per channel and CHALL) written as <label>-<idStr>.<format>,
+# no display, no mouse clicks, no raw_input: annotations come in as data. captures are spread over a
+# process pool, workers read stored captures from the trace store themselves, so only capture numbers
+# and file names cross between processes
+
+import os
+import sys
+import datetime
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import font_manager
+
+from tekscope import Channel, TektronixScope, sweepString
+from tracestore import TraceStore
+from plotter import ScopeDisplay
+
+class CaptureView(object):
+    # as much of an instrument as ScopeDisplay uses, made from one capture's TraceRecords
+    recordLength = TektronixScope.recordLength
+
+    def __init__(self, recL):
+        self._channelL = [ Channel(i, self) for i in (1,2,3,4) ]
+        for rec in recL:
+            self.getChannel(rec.chN).loadRecord(rec)
+        self._chanAcqL = [rec.chN for rec in recL]
+        self.sweepStr, self.sweep = sweepString(recL[0].wfmD['XINCR']*self.recordLength/10.0)
+
+    def getChannel(self, chN):
+        return self._channelL[chN-1]
+    def channelWasAcq(self, chN):
+        return chN in self._chanAcqL
+
+def captureId(recL):
+    # file name tag of a capture: host time as tekscope's TimeStamp, and the capture number
+    stamp = datetime.datetime.fromtimestamp(recL[0].t).isoformat().replace(':', '-').split('.')[0]
+    return '%s-%d'%(stamp, recL[0].capN)
+
+def renderCapture(recL, outDir='Traces', formats=('png',), annotL=(), chAll=True):
+    # the figures of one capture written to outDir, returns the paths
+    disp = ScopeDisplay(CaptureView(recL), captureId(recL), disp=False, save=False)
+    disp.render(sorted(rec.chN for rec in recL), chAll)
+    return disp.saveFigures(outDir, formats, annotL)
+
+_storeD = {}  # trace stores open in this process, by path
+
+def _initWorker():
+    # forked workers must not share the parent's open FreeType fonts; matplotlib versions without the font
+    # cache (or without it as an lru_cache) have nothing to clear
+    getFont = getattr(font_manager, '_get_font', None)
+    if hasattr(getFont, 'cache_clear'): getFont.cache_clear()
+    _storeD.clear()
+
+def _renderJob(job):
+    # one capture in a pool worker; a capture number is looked up in the store at path
+    cap, path, outDir, formats, annotL, chAll = job
+    if not isinstance(cap, list):
+        if path not in _storeD: _storeD[path] = TraceStore(path, 'r')
+        cap = _storeD[path].capture(cap)
+    return renderCapture(cap, outDir, formats, annotL, chAll)
+
+def renderCaptures(captures, path=None, outDir='Traces', formats=('png',), annotD=None, processes=None,
+                   chAll=True, chunksize=4):
+    """
+    Render a batch of captures, returns their paths as one list per capture, in order.
+    captures: capture numbers in the trace store at path, or lists of TraceRecords (as sequence()/stream()
+    give them, or TraceStore.capture()); annotD: {capN: [(figure label or None for all, x, y, text), ...]},
+    the None key applying to every capture. processes: pool size, None for one per CPU, 1 renders here.
+    """
+    annotD = annotD or {}
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+    jobL = []
+    for cap in captures:
+        capN = cap[0].capN if isinstance(cap, list) else cap
+        annotL = list(annotD.get(None, ())) + list(annotD.get(capN, ()))
+        jobL.append( (cap, path, outDir, tuple(formats), annotL, chAll) )
+    if processes == 1:
+        return map(_renderJob, jobL)
+    pool = Pool(processes, _initWorker)
+    try:
+        return pool.map(_renderJob, jobL, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='render the captures of a trace store to image files')
+    parser.add_argument('path', nargs='?', default=TektronixScope.storePath)
+    parser.add_argument('-o', '--outdir', default='Traces')
+    parser.add_argument('-f', '--format', nargs='+', default=['png'], help='png, svg, pdf, ...')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='default: one per CPU')
+    parser.add_argument('--last', type=int, default=None, help='only the last N captures')
+    parser.add_argument('--tag', default=None, help='text put on every CHALL figure')
+    args = parser.parse_args()
+
+    store = TraceStore(args.path, 'r')
+    capL = store.between()
+    store.close()
+    if args.last: capL = capL[-args.last:]
+    annotD = {None: [('CHALL', 0.2, 3.5, args.tag)]} if args.tag else None
+    pathLL = renderCaptures(capL, args.path, args.outdir, args.format, annotD, args.processes)
+    print '%d captures, %d files written to %s'%(len(pathLL), sum(map(len, pathLL)), args.outdir)
+    sys.exit(0)
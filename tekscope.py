@@ -25,21 +25,37 @@
 # see also: https://github.com/python-ivi
 
 
+import sys
+import errno
 import datetime
-from math import log10, ceil
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from math import log10, ceil, floor
 from string import split, upper
-from time import sleep
-from struct import unpack
-from serial import Serial   # we don't need no steenkin' VISA
-from numpy import array
+from time import sleep, time
+from struct import pack, unpack_from
+from serial import Serial, SerialTimeoutException   # we don't need no steenkin' VISA
+from numpy import frombuffer, dtype, empty, zeros, arange, isnan, float64, uint8
 
 import os
 
-from plotter import ScopeDisplay
+from hostmeas import measureBatch
+# no plotting here: matplotlib (plotter.py) only gets imported by display()
 
-# how long to sleep after issuing a write
+# how long to sleep after issuing a write, for the SLEEP wait policy and the serial break in clear()
 sleeptime = 0.01
 
+# what to do after a write, see TektronixScope.cmd/sync. strongest wins for compound commands
+# NONE:  nothing. the instrument queues commands in order, and a query blocks on its reply anyway
+#        (on USB the usbtmc read only returns once the EOM transfer has arrived)
+# WAI:   *WAI in the same message, the instrument finishes the command before it takes the next one; the host
+#        doesn't wait
+# SLEEP: the old fixed sleep(sleeptime)
+# BUSY:  poll BUSY? with backoff until the instrument is idle
+# OPC:   send *OPC? with the command, and block until the instrument answers 1
+waitT = ('NONE', 'WAI', 'SLEEP', 'BUSY', 'OPC')
+
 mNAN = 9.9e+37  # Tektronix "not a number"
 
 class Measurement(object):
@@ -68,12 +84,18 @@ class Measurement(object):
         self.reset()
 
     def getMeasStrLD(self):
-        return {m: getattr(self, m.lower()+'Str') for m in self.measL}        
+        return {m: self.val_to_string(getattr(self, m.lower()), m) for m in self.measL}
     def getMeasStrLL(self):
-        return [getattr(self, m.lower()+'Str') for m in self.measL]
+        return [self.val_to_string(getattr(self, m.lower()), m) for m in self.measL]
+
+    def __getattr__(self, name):
+        # <typ>Str, the display string, is only made when someone asks for it
+        if name.endswith('Str') and name[:-3].upper() in self.mtypeT:
+            return self.val_to_string(getattr(self, name[:-3]), name[:-3].upper())
+        raise AttributeError(name)
 
-    def __call__(self, keyL):
-        # this acquires the actual reading
+    def __call__(self, keyL, valD=None):
+        # this acquires the actual reading, unless it was already read in a batch and handed in as valD
         # we are not doiing the units, for now
         self.reset() # might not want to reset if we have new vals!!!
         self.measL = tuple( map(upper, keyL) )
@@ -81,14 +103,9 @@ class Measurement(object):
             if key not in self.mtypeT:
                 raise ValueError('Channel does not support %s IMMed TYPe'%key)
         
-            val = self._immed(key)
+            val = valD[key] if valD is not None else self._immed(key)
             
-            # we make nice strings for later retrieval
-            # means data is acquired throu call() and retrived via attribute
-            attrN = key.lower()+'Str'
-            setattr(self, attrN, self.val_to_string(val, key))
-
-            # store raw as attr
+            # store raw as attr, the nice strings are made from it at display time
             setattr(self, key.lower(), val)
             
         self.isReset=False # we have readings
@@ -123,6 +140,173 @@ class Measurement(object):
 def _strip(strBuf):
     return strBuf.replace('"', '')
 
+def splitSettings(resp):
+    # split a concatenated settings response into (header, value) pairs, full header paths
+    # relative headers replace the last node of the one before:
+    # ':TRIGGER:MAIN:MODE AUTO;TYPE EDGE;:CH1:SCALE 1.0E0' --> [('TRIGGER:MAIN:MODE', 'AUTO'), ('TRIGGER:MAIN:TYPE', 'EDGE'), ('CH1:SCALE', '1.0E0')]
+    partL = []
+    part = ''
+    quoted = False
+    for c in resp.strip():
+        if c=='"': quoted = not quoted
+        if c==';' and not quoted:
+            partL.append(part)
+            part = ''
+        else:
+            part = part+c
+    partL.append(part)
+
+    pairL = []
+    baseL = []
+    for part in partL:
+        part = part.strip()
+        if not part: continue
+        header, val = (part.split(None, 1)+[''])[:2]
+        if header[0]==':':
+            nodeL = header[1:].split(':')
+        elif header[0]=='*': # common commands are never relative
+            nodeL = [header]
+        else:
+            nodeL = baseL[:-1] + header.split(':')
+        baseL = nodeL
+        pairL.append( (':'.join(nodeL).upper(), val.strip()) )
+    return pairL
+
+def _nodeMatch(node, key):
+    # SCPI short form vs long form, either way round: SOU matches SOURCE
+    return node.startswith(key) or key.startswith(node)
+
+def pickSettings(pairL, funcD, stripT=()):
+    # map (header, value) pairs onto the keys of one of our *FuncD dicts, converting values on the way
+    # leading header nodes matching stripT are dropped first, e.g. ('TRIG', 'MAI') for the trigger keys
+    # a trailing VALUE node is ignored: TRIGGER:MAIN:HOLDOFF:VALUE is our HOLDO
+    keyD = dict( (tuple(key.split(':')), key) for key in funcD.keys() )
+    outD = {}
+    for header, val in pairL:
+        nodeL = header.split(':')
+        for strip in stripT:
+            if not nodeL or not _nodeMatch(nodeL[0], strip): break
+            nodeL = nodeL[1:]
+        if nodeL and nodeL[-1] in ('VALUE', 'VAL') and len(nodeL)>1:
+            nodeL = nodeL[:-1]
+        for keyT, key in keyD.items():
+            if len(keyT)==len(nodeL) and all(map(_nodeMatch, nodeL, keyT)):
+                func = funcD[key]
+                try:
+                    outD[key] = func(val) if func else val
+                except ValueError:
+                    outD[key] = val
+                break
+    return outD
+
+def sameSetting(old, new):
+    # does a setting already hold this value? numbers within rounding, keywords in short or long form
+    if old is None or new is None: return False
+    try:
+        old, new = float(old), float(new)
+        return abs(old-new) <= 1e-6*max(abs(old), abs(new))
+    except ValueError:
+        old, new = str(old).strip('"').upper(), str(new).strip('"').upper()
+        if not old or not new: return old==new
+        short, full = sorted((old, new), key=len)
+        # NORM is NORMAL, but EXT isn't EXT5: a keyword's long form never adds digits
+        return full.startswith(short) and not full[len(short):len(short)+1].isdigit()
+
+def sweepString(scaled):
+    # horizontal scale (s/div) as the screen shows it, and the scaled number: ('100\nms/DIV', 100.0)
+    sufD = {3:'m', 6:'u', 9:'n'}
+    if scaled >= 1:
+        suf = ' s'
+    if scaled < 1:
+        mulmod =3 * ceil( log10(1.0/scaled)  / 3)
+        scaled = scaled*10**mulmod
+        suf = sufD[mulmod]+'s'
+    sweepStr= '%.f' % scaled
+    return sweepStr + '\n' + (suf) + "/DIV", scaled
+
+def wfmDtype(wfmD):
+    # numpy dtype for the CURVE? binary block described by a parsed WFMPRE? preamble
+    # BYT_NR 1|2, BN_FMT RI (signed) | RP (positive/unsigned), BYT_OR LSB | MSB
+    nbytes = wfmD.get('BYT_NR', 1)
+    if nbytes not in (1, 2):
+        raise ValueError('Unsupported BYT_NR %s'%nbytes)
+    kind = 'u' if wfmD.get('BN_FMT', 'RI') == 'RP' else 'i'
+    order = '>' if wfmD.get('BYT_OR', 'LSB') == 'MSB' else '<'
+    return dtype('%s%s%d'%(order, kind, nbytes))
+
+def curveCodes(buf, wfmD, nbytes=None):
+    # zero-copy view of the raw curve codes in a CURVE? data block
+    # nbytes lets the caller hand over the raw read with the trailing newline still attached
+    dt = wfmDtype(wfmD)
+    if nbytes is None: nbytes = len(buf)
+    return frombuffer(buf, dtype=dt, count=nbytes//dt.itemsize)
+
+def decodeCurve(buf, wfmD, voltsdiv=None, nbytes=None):
+    # returns (codes, trace, trace_undisplaced)
+    wfm = Waveform(curveCodes(buf, wfmD, nbytes), wfmD, voltsdiv)
+    return wfm.codes, wfm.volts, wfm.divisions
+
+class Waveform(object):
+    """
+    One channel's curve as the instrument sent it: the raw codes, int8/int16 as on the wire, and the preamble
+    constants to scale them. volts, divisions (the undisplaced trace, on screen divisions around the channel
+    position) and time (s, relative to the trigger) are worked out on first use, scaled into float64 in place
+    without intermediate lists, and cached; compact() drops the cache again. A waveform kept compact costs
+    1-2 bytes a point instead of the 16 of two float64 traces.
+    """
+    def __init__(self, codes, wfmD, voltsdiv=None):
+        self.codes = codes
+        self.yoff, self.ymult, self.yzero = wfmD['YOFF'], wfmD['YMULT'], wfmD['YZERO']
+        # XZEro is the time of the record's first point, a DATa:STARt window begins START-1 points later
+        self.start = wfmD.get('START', 1)
+        self.xincr, self.ptOff = wfmD['XINCR'], wfmD.get('PT_OFF', 0)
+        self.xzero = wfmD['XZERO'] + (self.start-1)*self.xincr
+        # V/div, as the channel reported it or else from the preamble: 25 codes a division (x256 at 2 bytes)
+        self.voltsdiv = voltsdiv or self.ymult*25*256**(codes.itemsize-1)
+        self._volts = self._div = self._time = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def volts(self):
+        if self._volts is None:
+            volts = empty(len(self.codes), dtype=float64)
+            volts[:] = self.codes
+            volts -= self.yoff
+            volts *= self.ymult
+            volts += self.yzero
+            self._volts = volts
+        return self._volts
+
+    @property
+    def divisions(self):
+        if self._div is None:
+            self._div = self.divisionsInto(empty(len(self.codes), dtype=float64))
+        return self._div
+
+    def divisionsInto(self, div):
+        # the divisions written into a float64 buffer of len(self), e.g. one reused frame after frame
+        # screen centre is code 0, or the middle code for the unsigned RP encodings
+        div[:] = self.codes
+        if self.codes.dtype.kind == 'u': div -= 1 << (8*self.codes.itemsize-1)
+        div *= self.ymult/self.voltsdiv
+        return div
+
+    @property
+    def time(self):
+        # Xn = XZEro + XINcr * (n - PT_OFf)
+        if self._time is None:
+            t = arange(len(self.codes), dtype=float64)
+            t -= self.ptOff
+            t *= self.xincr
+            t += self.xzero
+            self._time = t
+        return self._time
+
+    def compact(self):
+        self._volts = self._div = self._time = None
+
 class Channel(object):
     wfmFuncD = {'BYT_NR':int,
                 'BIT_NR': int,
@@ -142,16 +326,18 @@ class Channel(object):
                 'YUNIT': _strip #"Volts"
             }
     wfmT = wfmFuncD.keys()
+    # wfmD also gets START, the DATa:STARt the preamble was read under: the curve's first point in the record
 
     chFuncD = { 'BAN': None, 
                 'COUP': None,
                 'INV': None,
                 'POS': float,
-                'PROBE': int,
+                'PROBE': float, # 1.0E1
                 'SCA': float,
                 'YUNIT': None
                 }
     chT = chFuncD.keys()    
+    queryOnlyT = ()  # chFuncD keys that can be read but not set
 
     # :WFMPRE:BYT_NR 1;BIT_NR 8;ENCDG BIN;BN_FMT RI;BYT_OR LSB;NR_PT
     # 2500;WFID "Ch3, DC coupling, 5.0E-1 V/div, 1.0E-1 s/div, 2500
@@ -161,16 +347,25 @@ class Channel(object):
 
     
     def __init__(self, chN, instr):
+        self._chN = chN
         self._channel = 'CH%1d'%chN
         self._instr = instr
         self._msmnt = Measurement(self.getImmed)
         self.wfmD = {}
+        self.wfm = None # Waveform of the last acquire()
+        self.chD = {}   # vertical settings, from acqSettings()
+        self._wfmValid = False # preamble cache, cleared by writes that change it
+
+    def invalidate(self):
+        # a setting behind the preamble changed, re-query WFMPRE? on the next acquire
+        self._wfmValid = False
 
     def getVerticalSetting(self):
         # 2,5,10,20,50, 100,200,500 mV/div 1,2,5 V/div
         # get instrument settings
-        voltsdiv=self._instr.query_float('%3s:scale?'%self._channel)
-        
+        self.setVoltsdiv( self._instr.query_float('%3s:scale?'%self._channel) )
+
+    def setVoltsdiv(self, voltsdiv):
         if voltsdiv >= 1:
             volt_string = '%i\nV/DIV' % (voltsdiv)
         else:
@@ -179,18 +374,27 @@ class Channel(object):
         self.voltsdiv = voltsdiv
 
     def __setitem__(self, key, val):
-        self._instr.cmd('CH%d:%s %s'%(self._channel, key, val))
+        self._instr.cmd('%s:%s %s'%(self._channel, key, val)) # cmd() invalidates our preamble
     def __getitem__(self, key):
-        ret = self._instr.query('CH%d:%s?'%(self._channel, key))
+        ret = self._instr.query_val('%s:%s?'%(self._channel, key))
         return map(self.chFuncD[key], (ret,))[0]
 
+    def acqSettings(self, pairL=None):
+        # all vertical settings in one CH<x>? query, or picked out of an instrument snapshot
+        if pairL is None: pairL = splitSettings(self._instr.query('%s?'%self._channel))
+        self.chD.update( pickSettings(pairL, self.chFuncD, (self._channel,)) )
+        return self.chD
+
     def getImmed(self, typ):
         self._instr.cmd('measu:imm:typ %s;:measu:imm:sou %3s'%(typ,self._channel))
         return self._instr.query_float('measu:imm:val?')
 
-    def acqMeas(self, mL):
+    def acqMeas(self, mL, valD=None):
         # acquire some measurements, available later as self.getMeasurements()
-        self._msmnt(mL)
+        # valD holds values already read by the MeasurementControl batch
+        if valD is None:
+            valD = self._instr._measCtl({self._chN: mL})[self._chN]
+        self._msmnt(mL, valD)
 
     def getMeasStrD(self):
         return self._msmnt.getMeasStrLD()
@@ -210,10 +414,49 @@ class Channel(object):
                 else:
                     self.wfmD[name] = val
 
+        if self._instr._dataStart is None: self._instr.readWindow()
+        self.wfmD['START'] = self._instr._dataStart
+
         # number of points in trace
         self.points = self.wfmD['NR_PT']
+        self._wfmValid = True
         if self._instr._debug: print self.wfmD
 
+    # the last acquired curve, see Waveform
+    codes = property(lambda self: self.wfm.codes)
+    trace = property(lambda self: self.wfm.volts)
+    trace_undisplaced = property(lambda self: self.wfm.divisions)
+
+    def divAxis(self):
+        # horizontal screen divisions (0-10 over the whole record) of the curve's points
+        x = arange(self.wfm.start-1, self.wfm.start-1+len(self.wfm), dtype=float64)
+        x *= 10.0/self._instr.recordLength
+        return x
+
+    def readCurve(self, prepare):
+        # the raw CURVE? data block, undecoded: (buffer, nbytes), the trailing newline still attached
+        self._instr.cmd('DATA:SOURCE %3s'%self._channel)
+        if prepare and not self._wfmValid: self.wfmpreQ()
+
+        tmp = self._instr.query('curv?', nBytes=9, more=True)
+        # header: :CURVE #42500
+        numChr = int(tmp[8])  # 4
+        tmp=self._instr.read(numChr)
+        nbytes = int(tmp)  # block length is in bytes, BYT_NR per point
+        if self._instr._debug: print 'Acquiring %d points'%(nbytes//self.wfmD['BYT_NR'])
+        tmp=self._instr.read(nbytes+1) # there's a newline at the end of the data
+        self._instr.endQuery()
+        return tmp, nbytes
+
+    def loadRecord(self, rec):
+        # take the curve, preamble and measurements of a TraceRecord, as if acquire() had read them
+        self.invalidate()  # not the instrument's current preamble
+        self.wfmD = dict(rec.wfmD)
+        self.points = len(rec.codes)
+        self.wfm = rec.wfm  # its voltsdiv comes from the preamble for streamed records
+        self.setVoltsdiv(self.wfm.voltsdiv)
+        self._msmnt(rec.measD.keys(), rec.measD)
+
     def acquire(self, prepare):
         # for ASCII read, use 'self.read(16384)' instead of the above, and 
         # delete the next two lines.  You'll need to use 'split' to convert the 
@@ -221,52 +464,137 @@ class Channel(object):
         # 'tmplist', and you may need to adjust the offsets used in the 'for' loop 
         # to end up with the proper number of points
 
-        self._instr.cmd('DATA:SOURCE %3s'%self._channel)
-        if prepare: self.wfmpreQ()
-
-        tmp = self._instr.query('curv?', nBytes=9)
-        # header: :CURVE #42500
-        numChr = int(tmp[8])  # 4
-        tmp=self._instr.read(numChr)
-        points = int(tmp)
-        if self._instr._debug: print 'Acquiring %d points'%points
-        tmp=self._instr.read(self.wfmD['BYT_NR']*points+1) #newline at end???
+        tmp, nbytes = self.readCurve(prepare)
+        self.wfm = Waveform(curveCodes(tmp, self.wfmD, nbytes), self.wfmD, self.voltsdiv)
+        self.points = len(self.wfm)
 
-        formatstring = '%ib' % (len(tmp))   # does this assume BYT_NR==1???
-        tmplist = unpack(formatstring,tmp)[:-1] # there's a newline at the end of the data, thus the strange slice
-        
-        yoff = self.wfmD['YOFF']
-        ymult = self.wfmD['YMULT']
-        yzero = self.wfmD['YZERO']
-        points = self.wfmD['NR_PT']
-        tmp = array( map(int, tmplist) )
-        self.trace =  (tmp - yoff) * ymult + yzero
-        self.trace_undisplaced = tmp*ymult/self.voltsdiv
-            
         if self._instr._debug: print self.trace
 
+class MeasurementControl(object):
+    """
+    Batched measurements for all channels at once, through the scope's persistent MEASUrement:MEAS<x> slots.
+
+    The slots are configured with one compound command, and only re-sent when the requested (channel, type) set
+    no longer fits what is already in them. All slot values then come back from one compound VALue? query.
+    Types that don't fit in the slots, or can't go in a slot at all (PHAse), fall back to MEASUrement:IMMed,
+    all of them in one more compound query.
+
+    NOTE: slot values are display values, updated about every 1/2 second. Slots are read no sooner than
+    slotSettle seconds after a reconfiguration, a completed acquisition (see stale()) or the previous read, so
+    every reading is of the current record and none is read twice. That suits free running reads (measLoop);
+    after a single sequence immed() reads the stopped record straight away instead.
+    """
+    slotT = ('FREQ', 'MEAN', 'PERI', 'PK2P', 'CRMS', 'MINI', 'MAXI', 'RISE', 'FALL', 'PWID', 'NWID') # no PHAS
+    slotSettle = 0.6
+
+    def __init__(self, instr, nSlots=4):
+        self._instr = instr
+        self._nSlots = nSlots
+        self._slotL = [] # (chN, typ) in MEAS1, MEAS2, ...
+        self._freshT = 0.0 # host time the slots hold values worth reading from
+
+    def stale(self, t=None):
+        # what the slots show now predates something (new slot types, a new acquisition at host time t):
+        # the next read waits for the display to refresh them
+        self._freshT = max(self._freshT, (t or time()) + self.slotSettle)
+
+    def _allocate(self, chmD):
+        # split the requests into slot and IMMed measurements, reusing the current slots where possible
+        slotL = []
+        immedL = []
+        for chN in sorted(chmD.keys()):
+            for typ in map(upper, chmD[chN]):
+                if typ not in Measurement.mtypeT:
+                    raise ValueError('Channel does not support %s IMMed TYPe'%typ)
+                if typ in self.slotT:
+                    slotL.append((chN, typ))
+                else:
+                    immedL.append((chN, typ))
+        if len(slotL)>self._nSlots:
+            immedL.extend(slotL[self._nSlots:])
+            slotL = slotL[:self._nSlots]
+        if set(slotL) <= set(self._slotL):
+            return self._slotL, immedL
+        return slotL, immedL
+
+    def _configure(self, slotL):
+        cmdL = []
+        for i, (chN, typ) in enumerate(slotL):
+            if i<len(self._slotL) and self._slotL[i]==(chN, typ): continue
+            cmdL.append('MEASU:MEAS%d:TYP %s;:MEASU:MEAS%d:SOU CH%1d'%(i+1, typ, i+1, chN))
+        if not cmdL: return
+        self._instr.cmd(';:'.join(cmdL))
+        self._slotL = slotL + self._slotL[len(slotL):]
+        self.stale()
+
+    def immed(self, chmD):
+        # {chN: {typ: val}} through MEASUrement:IMMed, every measurement in one compound query
+        # IMMed values are worked out from the record when queried, nothing to wait for once an acquisition is done
+        pairL = [ (chN, typ) for chN in sorted(chmD.keys()) for typ in map(upper, chmD[chN]) ]
+        valD = {chN: {} for chN in chmD.keys()}
+        if not pairL: return valD
+        for chN, typ in pairL:
+            if typ not in Measurement.mtypeT:
+                raise ValueError('Channel does not support %s IMMed TYPe'%typ)
+        resp = self._instr.query(';:'.join('MEASU:IMM:TYP %s;:MEASU:IMM:SOU CH%1d;:MEASU:IMM:VAL?'%(typ, chN)
+                                           for chN, typ in pairL))
+        for (chN, typ), val in zip(pairL, resp.strip().split(';')):
+            valD[chN][typ] = float(val.split()[-1])
+        return valD
+
+    def __call__(self, chmD):
+        # returns {chN: {typ: val}} for every requested measurement
+        slotL, immedL = self._allocate(chmD)
+        self._configure(slotL)
+        valD = {chN: {} for chN in chmD.keys()}
+
+        wanted = set((chN, typ) for chN, mL in chmD.items() for typ in map(upper, mL))
+        idxL = [i for i, pair in enumerate(self._slotL) if pair in wanted]
+        if idxL:
+            left = self._freshT - time()
+            if left > 0: self._instr.nap(left)
+            resp = self._instr.query(';:'.join('MEASU:MEAS%d:VAL?'%(i+1) for i in idxL))
+            self.stale()  # the same values until the next refresh
+            for i, val in zip(idxL, resp.strip().split(';')):
+                chN, typ = self._slotL[i]
+                valD[chN][typ] = float(val.split()[-1])
+
+        immD = {}
+        for chN, typ in immedL:
+            immD.setdefault(chN, []).append(typ)
+        for chN, immValD in self.immed(immD).items():  # all of them in one query
+            valD[chN].update(immValD)
+        return valD
+
 class HorizontalControl(object):
     horFuncD = { 'HOR:VIEW': None,
                  'HOR:MAIN:POS': float,
                  'HOR:MAIN:SCA': float
                 }
     horT = horFuncD.keys()
+    queryOnlyT = ()
                 
     def __init__(self, instr):
         self._instr = instr
         self._horD = {}
 
     def __getitem__(self, key): # upwards
-        val= self._instr.query_val(key)
-        func = self.horFuncD[val]
+        val= self._instr.query_val(key+'?')
+        func = self.horFuncD[key]
         if func:
             val = func(val)
         return val
 
+    def acqSettings(self, pairL=None):
+        # all horizontal settings in one HORizontal? query, or picked out of an instrument snapshot
+        if pairL is None: pairL = splitSettings(self._instr.query('HOR?'))
+        self._horD.update( pickSettings(pairL, self.horFuncD) )
+        return self._horD
+
     def __setitem__(self, key, val): # downwards
-        if not val: return 
-        if key not in self.horT: raise ValueError('%s not in trigger dictionary'%key)
-        self._instr.cmd('%s %s'%(key, val)) # in instrument
+        if val is None: return 
+        if key not in self.horT: raise ValueError('%s not in horizontal dictionary'%key)
+        self._instr.cmd('%s %s'%(key, val)) # in instrument, cmd() invalidates the preambles
 
 class TriggerControl(object):
     trigFuncD = {'STATE': None, # No MAIN: prepended, shrug
@@ -288,6 +616,7 @@ class TriggerControl(object):
                  'VID:SYNC': None
                 }
     trigT = trigFuncD.keys()
+    queryOnlyT = ('STATE',)  # trigger status, not a setting
     # no comment, must be a simpler way, have no time to figure it out!!!!!:
     mainD = {}
     edgeD = {}
@@ -313,37 +642,24 @@ class TriggerControl(object):
         self._trigD['STATE'] = self._instr.query_val('TRIG:STATE?')
         return self._trigD['STATE']
 
-    def _acqD(self, typ):
-        query=self._instr.query_val
-        theD = self.trigTypesD[typ]
-        name = 'TRIGGER:MAIN:'
-        key=''
-        pref=typ
-        if pref != 'MAIN':
-            name=name + pref + ':'
-            key=pref+':'
-        for s, func in theD.items():
-            val = query(name+'%s?'%s)
-            if func:
-                val = func(val)
-            self._trigD[key+s]=val
-
     def _setD(self, typ, kwD):
-        query=self._instr.cmd
         setT = self.trigTypesD[typ].keys()
         name = '%s:'%typ
-        for key, val in kwD.items():
+        for key in kwD.keys():
             if key not in setT: raise IndexError('%s not in (%s)'%(key,setT))
-            self[name+key] = val
+        with self._instr.buffered():
+            for key, val in kwD.items():
+                self[name+key] = val
             
     def setTrigger(self, level, mode, holdo, typ, trigD):
-        self['LEVEL'] = level
-        self['MODE'] = mode
-        self['HOLDO'] = holdo
-        if typ: 
-            if typ not in self.trigTypesD.keys(): raise TypeError('%s is not a trigger type'%typ)
-            self._setD(typ, trigD)
-            self['TYPE'] = typ
+        if typ and typ not in self.trigTypesD.keys(): raise TypeError('%s is not a trigger type'%typ)
+        with self._instr.buffered():
+            self['LEVEL'] = level
+            self['MODE'] = mode
+            self['HOLDO'] = holdo
+            if typ: 
+                self._setD(typ, trigD)
+                self['TYPE'] = typ
 
     def getTrigger(self, forceAcq = False):
         if forceAcq: self.acqSettings()
@@ -354,20 +670,413 @@ class TriggerControl(object):
             trigD[key]= self[typ+':'+ key]
         return trigD
 
-    def acqSettings(self):
-        self.acqState()
-        self._acqD('MAIN')
-        self._acqD(self._trigD['TYPE'])
+    def acqSettings(self, pairL=None):
+        # all trigger settings in one compound TRIGger:MAIn?/TRIGger:STATE? query, or picked out of an instrument snapshot
+        if pairL is None: pairL = splitSettings(self._instr.query('TRIG:MAI?;:TRIG:STATE?'))
+        self._trigD.update( pickSettings(pairL, self.trigFuncD, ('TRIG', 'MAI')) )
+        return self._trigD
 
     def __getitem__(self, key): # upwards
         return self._trigD[key]
 
     def __setitem__(self, key, val): # downwards
-        if not val: return 
+        if val is None: return 
         if key not in self.trigT: raise ValueError('%s not in trigger dictionary'%key)
-        self._instr.cmd('TRIGGER:MAIN:%s %s'%(key, val)) # in instrument
-        # now store local
-        self._trigD[key]=val
+        self._instr.cmd('TRIGGER:MAIN:%s %s'%(key, val)) # in instrument, cmd() invalidates the preambles
+        # and cmd() writes through to our local _trigD
+
+class TraceRecord(object):
+    # one channel of one capture, as handed out by TraceStream, SequenceLoop and TraceStore
+    # t: host time (s) the capture was seen complete, capN: capture number, chN: channel,
+    # codes: raw curve codes (numpy, dtype per the preamble), wfmD: the preamble, measD: {typ: val}
+    # voltsdiv and trigD (trigger settings) where known
+    def __init__(self, t, capN, chN, codes, wfmD, measD, voltsdiv=None, trigD=None):
+        self.t = t
+        self.capN = capN
+        self.chN = chN
+        self.codes = codes
+        self.wfmD = wfmD
+        self.measD = measD
+        self.voltsdiv = voltsdiv
+        self.trigD = trigD
+        self._wfm = None
+
+    @property
+    def wfm(self):
+        # a Waveform of the codes, made on first use
+        if self._wfm is None:
+            self._wfm = Waveform(self.codes, self.wfmD, self.voltsdiv)
+        return self._wfm
+
+    def trace(self):
+        # volts
+        return self.wfm.volts
+
+class TraceRing(object):
+    """
+    Bounded ring of preallocated capture slots between the stream's I/O thread (put) and the consumer (get).
+
+    The raw curve bytes of all channels of a capture are copied into one slot of a capacity x maxBytes block
+    allocated once, so memory stays flat no matter how long the stream runs. policy says what a put() into a
+    full ring does:
+      DROP:  overwrite the oldest capture, counted in dropped (the I/O thread never stalls)
+      BLOCK: wait for the consumer to make room (backpressure, nothing is lost, the capture rate drops)
+    Captures go in and come out whole, a dropped one takes all its channels with it.
+    """
+    policyT = ('DROP', 'BLOCK')
+    pollT = 0.5  # seconds, a bare Condition.wait() can't be interrupted by ^C
+
+    def __init__(self, capacity=64, maxBytes=5000, policy='DROP'):
+        if policy not in self.policyT: raise ValueError('Not a ring policy: %s'%policy)
+        self.capacity = capacity
+        self.policy = policy
+        self._buf = zeros((capacity, maxBytes), dtype=uint8)
+        self._metaL = [None]*capacity  # (t, capN, [(chN, offset, nbytes, dtype, wfmD, measD), ...]) per slot
+        self._head = 0   # oldest record
+        self._count = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self.puts = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, t, capN, chanL):
+        # one capture, chanL: [(chN, buf, nbytes, wfmD, measD), ...]
+        # False once the ring has been closed, the producer should stop
+        total = sum(nbytes for chN, buf, nbytes, wfmD, measD in chanL)
+        if total > self._buf.shape[1]:
+            raise ValueError('Capture of %d bytes does not fit the %d byte ring slots'%(total, self._buf.shape[1]))
+        with self._cond:
+            while self._count == self.capacity and not self._closed:
+                if self.policy == 'DROP':
+                    self._head = (self._head+1) % self.capacity
+                    self._count -= 1
+                    self.dropped += 1
+                else:
+                    self._cond.wait(self.pollT)
+            if self._closed: return False
+            i = (self._head+self._count) % self.capacity
+            off = 0
+            metaL = []
+            for chN, buf, nbytes, wfmD, measD in chanL:
+                self._buf[i, off:off+nbytes] = frombuffer(buf, dtype=uint8, count=nbytes)
+                metaL.append( (chN, off, nbytes, wfmDtype(wfmD), wfmD, measD) )
+                off += nbytes
+            self._metaL[i] = (t, capN, metaL)
+            self._count += 1
+            self.puts += 1
+            self._cond.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        # the oldest capture as a list of TraceRecords, their codes copied out of the ring; None once closed
+        # and empty, or when timeout (s) runs out
+        tmo = None if timeout is None else time()+timeout
+        with self._cond:
+            while not self._count:
+                if self._closed: return None
+                if tmo is None:
+                    self._cond.wait(self.pollT)
+                else:
+                    left = tmo-time()
+                    if left <= 0: return None
+                    self._cond.wait(min(left, self.pollT))
+            i = self._head
+            t, capN, metaL = self._metaL[i]
+            recL = [ TraceRecord(t, capN, chN, self._buf[i, off:off+nbytes].copy().view(dt), wfmD, measD)
+                     for chN, off, nbytes, dt, wfmD, measD in metaL ]
+            self._metaL[i] = None
+            self._head = (i+1) % self.capacity
+            self._count -= 1
+            self._cond.notify_all()
+        return recL
+
+    def close(self):
+        # no more puts; get() drains what is left, then returns None
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class TraceStream(object):
+    """
+    Continuous acquisition, see TektronixScope.stream(). A background I/O thread re-arms the scope, reads the
+    measurements and the raw curves of the requested channels and puts them in a TraceRing; iterating yields
+    TraceRecords, one per channel per capture, in order.
+
+    single: re-arm a single SEQuence for every capture and wait for it (waitAcq), so all channels of a
+            record come from the same trigger. Otherwise the scope free runs and each read takes whatever
+            capture is on screen.
+
+    The measurements are worked out on the host from each capture's curves (hostmeas.py): the scope's own
+    measurement slots only refresh every 1/2 second, so they would belong to some earlier capture.
+    A trigger gap longer than acqTimeout does not end the stream, the armed scope keeps waiting and the gap
+    is counted in gaps. Nothing else may talk to the instrument while the stream runs. close(), or leaving a
+    with block, stops the thread, waking it from a trigger wait, and leaves the scope running or stopped as it
+    found it; an exception in the I/O thread is re-raised in the consumer.
+    """
+    def __init__(self, instr, chmD, capacity=64, policy='DROP', single=True, maxCaptures=None):
+        self._instr = instr
+        self._chmD = chmD
+        self._single = single
+        self._maxCaptures = maxCaptures
+        self.ring = TraceRing(capacity, instr.maxCurveBytes*len(chmD), policy)
+        self.captures = 0
+        self.gaps = 0  # waits for a trigger that ran past acqTimeout
+        self._excInfo = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='TraceStream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        instr = self._instr
+        prevAcq = None
+        try:
+            prevAcq = instr.getAcqState()
+            if self._single:
+                instr.setAcqState('STOP', 'SEQUENCE')
+            else:
+                instr.setAcqState('RUN')
+            chNL = sorted(self._chmD.keys())
+            while not self._stop.is_set():
+                if self._maxCaptures is not None and self.captures >= self._maxCaptures: break
+                if self._single:
+                    instr.arm()
+                    if not self._waitCapture(): break
+                t = time()
+                chanL = []
+                for chN in chNL:
+                    chan = instr.getChannel(chN)
+                    buf, nbytes = chan.readCurve(True)
+                    chanL.append( [chN, buf, nbytes, dict(chan.wfmD), {}] )
+                if any(self._chmD.values()):
+                    wfmD = dict( (chN, Waveform(curveCodes(buf, wfmD, nbytes), wfmD))
+                                 for chN, buf, nbytes, wfmD, measD in chanL )
+                    valD = instr.hostMeasure(self._chmD, wfmD)
+                    for ch in chanL:
+                        ch[4] = OrderedDict( (typ, valD[ch[0]][typ]) for typ in map(upper, self._chmD[ch[0]]) )
+                if not self.ring.put(t, self.captures, chanL): return
+                self.captures += 1
+        except Exception:
+            self._excInfo = sys.exc_info()
+        finally:
+            self.ring.close()
+            try:
+                if prevAcq: instr.setAcqState(*prevAcq)
+            except Exception:
+                if self._excInfo is None: self._excInfo = sys.exc_info()
+
+    def _waitCapture(self):
+        # the armed sequence, however long the trigger takes; False once close() stops the wait
+        while 1:
+            try:
+                return self._instr.waitAcq(stop=self._stop) is not None
+            except ValueError:  # no trigger within acqTimeout: a gap, not the end of the run
+                self.gaps += 1
+
+    def __iter__(self):
+        while True:
+            recL = self.ring.get()
+            if recL is None: break
+            for rec in recL:
+                yield rec
+        self._thread.join()
+        if self._excInfo:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+
+    def close(self):
+        # returns once the I/O thread has finished the read it is in, a trigger wait is cut short
+        self._stop.set()
+        self.ring.close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+class SequenceLoop(object):
+    """
+    Triggered captures back to back in single SEQuence mode, see TektronixScope.sequence(). Each pass waits for
+    the trigger, reads the raw curves of the channels, re-arms at once and only then decodes, so the decode
+    (and whatever the consumer does with the capture) happens while the scope is already waiting for the next
+    trigger. Iterating yields one list of TraceRecords per capture, traces already decoded. Once the loop moves
+    on to the next capture the records are compacted back to their codes (Waveform.compact), so captures kept
+    by the consumer cost 1-2 bytes a point, trace() decodes them again if asked.
+
+    Dead time is the time from a completed sequence to the next arm, when triggers go unseen. Assuming triggers
+    come at random at a steady rate, estimated from how long the armed scope waits for one, missed ~ rate x total
+    dead time (a strictly periodic trigger waits half as long on average, and is overestimated 2x).
+    The measurement slots only refresh every 1/2 second, so captures carry no measurements.
+    """
+    def __init__(self, instr, chNL, n=None):
+        self._instr = instr
+        self._chNL = sorted(chNL)
+        self._n = n
+        self.captures = 0
+        self.deadT = 0.0   # summed seconds from completion to re-arm
+        self.armedT = 0.0  # summed seconds from arm to completion
+        self._t0 = None
+        self._tEnd = None
+
+    def __iter__(self):
+        instr = self._instr
+        prevAcq = instr.getAcqState()
+        instr.setAcqState('STOP', 'SEQUENCE')
+        self._t0 = time()
+        tArm = self._t0
+        recL = []
+        try:
+            instr.arm()
+            while self._n is None or self.captures < self._n:
+                instr.waitAcq()
+                tDone = time()
+                blockL = []
+                for chN in self._chNL:
+                    chan = instr.getChannel(chN)
+                    buf, nbytes = chan.readCurve(True)
+                    blockL.append( (chN, buf, nbytes, dict(chan.wfmD)) )
+                instr.arm()
+                self.armedT += tDone - tArm
+                tArm = time()
+                self.deadT += tArm - tDone
+                recL = []
+                for chN, buf, nbytes, wfmD in blockL:
+                    rec = TraceRecord(tDone, self.captures, chN, curveCodes(buf, wfmD, nbytes), wfmD, {})
+                    rec.trace()
+                    recL.append(rec)
+                self.captures += 1
+                yield recL
+                for rec in recL: rec.wfm.compact()
+        finally:
+            for rec in recL: rec.wfm.compact()
+            self._tEnd = time()
+            instr.setAcqState(*prevAcq)  # leaves no sequence armed behind us
+
+    def stats(self):
+        # capture rate (1/s), dead time (s per capture, and as a fraction), trigger rate and missed triggers
+        elapsed = (self._tEnd or time()) - self._t0 if self._t0 else 0.0
+        n = self.captures
+        trigRate = n/self.armedT if self.armedT else 0.0
+        return {'captures': n, 'elapsed': elapsed,
+                'rate': n/elapsed if elapsed else 0.0,
+                'deadTime': self.deadT/n if n else 0.0,
+                'deadFraction': self.deadT/elapsed if elapsed else 0.0,
+                'armedTime': self.armedT/n if n else 0.0,
+                'trigRate': trigRate,
+                'missed': trigRate*self.deadT}
+
+class ScopeMetrics(object):
+    """
+    Opt-in I/O accounting for a TektronixScope, see enableMetrics() and profile().
+
+    Per SCPI mnemonic (the header of the first command in a message, '?' kept for queries): messages sent, their
+    wall time with a log histogram, and raw I/O time and bytes out/in. I/O is booked on the mnemonic of the last
+    message until the next one, so a CURVE? data block lands on CURV?, whose wall time runs to the end of the
+    block (see TektronixScope.endQuery). Commands coalesced by buffered() are
+    counted under their own mnemonic as queued. Across all of them: fixed sleeps (SLEEP policy, slot settling,
+    ...) against waiting on the device (*OPC?, BUSY? polling, acquisition complete), and timeouts, including
+    reads that came back short.
+    """
+    histLo, histPerDecade, histBins = -6, 4, 40  # wall time histogram bins, from 1 us, 4 a decade
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.keyD = {}
+        self.sleepT = 0.0
+        self.waitT = 0.0
+        self.timeouts = 0
+        self._key = '-'
+        self._depth = 0  # nested I/O calls (readline on top of read) are booked once
+        self.t0 = time()
+        self.t1 = None
+
+    def stop(self):
+        self.t1 = time()
+
+    def _entry(self, key):
+        e = self.keyD.get(key)
+        if e is None:
+            e = self.keyD[key] = {'msgs': 0, 'queued': 0, 'time': 0.0, 'io': 0.0, 'out': 0, 'in': 0,
+                                  'hist': [0]*self.histBins}
+        return e
+
+    @staticmethod
+    def mnemonic(msg):
+        return msg.strip().lstrip(':').split(';', 1)[0].split(' ', 1)[0].upper()
+
+    def begin(self, msg):
+        self._key = self.mnemonic(msg)
+        return time()
+
+    def end(self, t0):
+        dt = time()-t0
+        e = self._entry(self._key)
+        e['msgs'] += 1
+        e['time'] += dt
+        i = int((log10(dt) - self.histLo)*self.histPerDecade) if dt > 0 else 0
+        e['hist'][min(max(i, 0), self.histBins-1)] += 1
+
+    def queued(self, cmdS):
+        self._entry(self.mnemonic(cmdS))['queued'] += 1
+
+    def io(self, func, args, nOut, want):
+        # call a raw read/readline/write and book it; want: bytes asked for, or '\n' for a line
+        if self._depth: return func(*args)
+        self._depth += 1
+        t0 = time()
+        try:
+            data = func(*args)
+        finally:
+            self._depth -= 1
+        e = self._entry(self._key)
+        e['io'] += time()-t0
+        e['out'] += nOut
+        if want is not None:
+            e['in'] += len(data)
+            if (data[-1:] != '\n') if want == '\n' else (len(data) < want): self.timeouts += 1
+        return data
+
+    def slept(self, seconds):
+        self.sleepT += seconds
+
+    def waited(self, seconds):
+        self.waitT += seconds
+
+    def timedOut(self):
+        self.timeouts += 1
+
+    def snapshot(self):
+        # plain dicts and lists, ready for json.dump
+        elapsed = (self.t1 or time()) - self.t0
+        keyD = {}
+        for key, e in self.keyD.items():
+            e = dict(e, hist=list(e['hist']))
+            e['mean'] = e['time']/e['msgs'] if e['msgs'] else 0.0
+            keyD[key] = e
+        edges = [10**(self.histLo + float(i)/self.histPerDecade) for i in range(self.histBins+1)]
+        return {'elapsed': elapsed, 'sleep': self.sleepT, 'deviceWait': self.waitT, 'timeouts': self.timeouts,
+                'bytesOut': sum(e['out'] for e in keyD.values()), 'bytesIn': sum(e['in'] for e in keyD.values()),
+                'histEdges': edges, 'mnemonics': keyD}
+
+    def report(self):
+        # display lines, most expensive mnemonic first
+        snap = self.snapshot()
+        lineL = ['%-20s %6s %6s %10s %10s %8s %8s'%('mnemonic', 'msgs', 'queued', 'time ms', 'io ms', 'out', 'in')]
+        for key, e in sorted(snap['mnemonics'].items(), key=lambda kv: -kv[1]['time']-kv[1]['io']):
+            lineL.append('%-20s %6d %6d %10.3f %10.3f %8d %8d'%(key, e['msgs'], e['queued'], 1e3*e['time'], 1e3*e['io'], e['out'], e['in']))
+        lineL.append('elapsed %.3f s, fixed sleeps %.3f s, device waits %.3f s, %d timeouts, %d bytes out, %d in'%(
+            snap['elapsed'], snap['sleep'], snap['deviceWait'], snap['timeouts'], snap['bytesOut'], snap['bytesIn']))
+        return lineL
 
 class TektronixScope(object):
     """
@@ -378,30 +1087,82 @@ class TektronixScope(object):
     4. could autostore data (tables best for this)
     """
     
+    # command headers (short forms) whose writes change the WFMPRE? preamble of every channel
+    # DATa:SOUrce is left out on purpose, each channel keeps its own preamble
+    _wfmAllT = ('HOR', 'WFMP', 'TRIG', 'AUTOS', 'RECA', 'FAC', '*RST', '*RCL')
+    _wfmSubD = {'DAT': ('STAR', 'STOP', 'ENC', 'WID'),
+                'ACQ': ('MOD', 'NUMAV')}
+    # command headers that throw away the instrument settings, and with them our shadow state
+    _resetT = ('AUTOS', 'RECA', 'FAC', '*RST', '*RCL')
+    _nMeasSlots = 4  # MEASUrement:MEAS<x>, 4 on the TDS200 series
+
+    # per-command wait policy by header prefix (short form nodes, e.g. ACQ:STATE), anything else gets defaultWait
+    # the *OPC table (2-30) covers calibration, single sequence acquisitions and hard copy
+    waitPolicyD = {'*CAL': 'OPC', 'CAL': 'OPC',
+                   'AUTOS': 'OPC', '*RST': 'OPC', 'FAC': 'OPC', '*RCL': 'OPC', 'RECA': 'OPC',
+                   '*SAV': 'OPC', 'SAV': 'OPC',
+                   'HARDC': 'BUSY'}
+    defaultWait = 'NONE'
+    busyTimeout = 10.0  # seconds
+    hostMeas = False  # acquire() works the measurements out from the curves (hostmeas.py), no scope queries
+    phaseRef = 1      # PHAS reference channel for host measurements
+    storePath = 'scope.dat'  # dump()/load() trace store
+    metrics = None          # ScopeMetrics while counting, see enableMetrics()
+    _queryT0 = None         # start of a query whose reply is still being read, see endQuery()
+    recordLength = 2500     # points, HORizontal:RECOrdlength
+    maxCurveBytes = 2*2500  # a whole record at DATa:WIDth 2, sizes the stream ring slots
+    acqTimeout = 10.0   # seconds waitAcq() waits for a trigger
+    stopPoll = 0.5      # seconds, longest a stoppable waitAcq() goes without looking at its stop event
+    pollMin, pollMax = 0.001, 0.05  # ACQ:STATE? polling backoff, seconds
+    maxMsgLen = 512     # flush a coalesced command buffer before it gets longer than this
+
     def __init__(self, debug=False, horScale=None, horPos=None):
         self._debug = debug
-        self.connect()
-        self.clear()
-        self.identify()
+        self._cmdL = []         # commands queued by buffered(), see flush()
+        self._cmdWait = 'NONE'  # strongest wait policy among them
+        self._bufDepth = 0
+        self._srqOn = False     # *ESE/*SRE set up for acquisition complete, see arm()
+        self._dataStart = self._dataStop = None  # DATa:STARt/STOP, read by readWindow(), see setWindow()
+        self._acqEst = 0.0      # running estimate of how long a single sequence takes to trigger
         self._channelL=[]
         self._channelAcqL=[]
         for i in (1,2,3,4):
             self._channelL.append( Channel(i,self) )
+        self.connect()
+        self.clear()
+        self.identify()
+        self.readWindow()  # an earlier session may have left a window set
         self._triggerCtl = TriggerControl(self)
         self._horCtl = HorizontalControl(self)
-        if horScale: self._horCtl['HOR:MAIN:SCA']=horScale
-        if horPos: self._horCtl['HOR:MAIN:POS']=horPos
+        self._measCtl = MeasurementControl(self, self._nMeasSlots)
+        with self.buffered():
+            if horScale: self._horCtl['HOR:MAIN:SCA']=horScale
+            if horPos: self._horCtl['HOR:MAIN:POS']=horPos
 
     def identify(self):
-        sleep(sleeptime)
         self.write('*IDN?'+'\n')
-        sleep(sleeptime)
         resp=self.readline()
         if resp.strip() == self._idStr:
             print resp.strip()
         else:
             raise ValueError('Failed to get instrument id (%s)'%resp)
 
+    def snapshot(self, useSET=False):
+        # the whole instrument state in one round trip, parsed into the trigger, horizontal and channel dicts
+        # useSET asks for everything (SET?), otherwise just the subsystems we model
+        # returns {header: value} for everything in the response
+        if useSET:
+            resp = self.query('SET?')
+        else:
+            reqL = ['TRIG:MAI?', 'TRIG:STATE?', 'HOR?'] + ['%s?'%chan._channel for chan in self._channelL]
+            resp = self.query(';:'.join(reqL))
+        pairL = splitSettings(resp)
+        self._triggerCtl.acqSettings(pairL)
+        self._horCtl.acqSettings(pairL)
+        for chan in self._channelL:
+            chan.acqSettings(pairL)
+        return dict(pairL)
+
     def getChannel(self, chN):
         return self._channelL[chN-1]
     def channelWasAcq(self, chN):
@@ -415,24 +1176,50 @@ class TektronixScope(object):
     def getTrigger(self, forceAcq):
         return self._triggerCtl.getTrigger(forceAcq)
 
-    def query(self, req, nBytes=None):
+    def query(self, req, nBytes=None, more=False):
+        # more: the reply goes on past what is read here (a CURVE? data block), endQuery() marks its end
+        m = self.metrics
+        if self._cmdL:
+            # pending commands ride along in the same message, unless they have to be waited for
+            if self._cmdWait in ('NONE', 'WAI'):
+                req = self._joinCmds(self._cmdL+(['*WAI'] if self._cmdWait=='WAI' else [])+[req])
+                self._cmdWait = 'NONE'
+                self._cmdL = []
+            else:
+                self.flush()
         if self._debug:
             print "send to Serial: ", req
+        if m: t0 = m.begin(req)
         self.write(req+'\n')
-        sleep(sleeptime)
         if nBytes:
             resp=self.read(nBytes)
         else:
             resp=self.readline()
+        if m:
+            if more:
+                self._queryT0 = t0
+            else:
+                m.end(t0)
         if self._debug:
             print "got from Serial: ", resp,
         return resp  # for dog's sake, remove the CR once and for all
 
+    def endQuery(self):
+        # the rest of a query(more=True) reply has been read, for the metrics' wall time
+        if self.metrics and self._queryT0 is not None: self.metrics.end(self._queryT0)
+        self._queryT0 = None
+
     def setAcqState(self, state, stopAfter='RUNSTOP'):
         if state not in ('STOP', 'RUN', 'ON', 'OFF'):
             raise ValueError('Not an acquisition state: %s'%state)
-        self.cmd('ACQ:STATE %s'%state)
-        self.cmd('ACQ:STOPA %s'%stopAfter)
+        with self.buffered():
+            self.cmd('ACQ:STOPA %s'%stopAfter)  # first: RUN under STOPA SEQ would start a single sequence
+            self.cmd('ACQ:STATE %s'%state)
+
+    def getAcqState(self):
+        # (state, stopAfter) as the instrument has them now, as setAcqState() takes them
+        state, stopAfter = [val for header, val in splitSettings(self.query('ACQ:STATE?;STOPA?'))]
+        return ('RUN' if state in ('1', 'ON', 'RUN') else 'STOP'), stopAfter
         
     def query_val(self, req):
         resp = self.query(req)
@@ -444,65 +1231,487 @@ class TektronixScope(object):
         if self._debug: print 'query_float:%s'%resp
         return resp
 
-    def cmd(self, cmdS):
+    def cmd(self, cmdS, wait=None):
+        # wait overrides the per-command policy, one of waitT
+        if wait is None: wait = self.waitPolicy(cmdS)
+        if wait not in waitT: raise ValueError('Not a wait policy: %s'%wait)
+        self._wfmWrite(cmdS)
+        self._shadowWrite(cmdS)
+        if self._bufDepth:
+            if self._cmdL and len(self._joinCmds(self._cmdL+[cmdS]))>self.maxMsgLen:
+                self.flush()
+            if self._debug: print "queued: ", cmdS, wait
+            if self.metrics: self.metrics.queued(cmdS)
+            self._cmdL.append(cmdS)
+            if waitT.index(wait)>waitT.index(self._cmdWait): self._cmdWait = wait
+            return
+        self._send(cmdS, wait)
+
+    def _send(self, cmdS, wait):
         if self._debug:
-            print "send to Serial: ", cmdS
-        self.write(cmdS+'\n')
-        sleep(sleeptime)
+            print "send to Serial: ", cmdS, wait
+        m = self.metrics
+        if m: t0 = m.begin(cmdS)
+        if wait=='OPC':
+            # the *OPC? reply can only come back once the command has completed, saves a write
+            self.write(cmdS+';*OPC?\n')
+            self.readline()
+            if m: m.waited(time()-t0)
+        elif wait=='WAI':
+            self.write(cmdS+';*WAI\n')
+        else:
+            self.write(cmdS+'\n')
+            self.sync(wait)
+        if m: m.end(t0)
+
+    @staticmethod
+    def _joinCmds(cmdL):
+        # one compound message, every command from the root: CMD1;:CMD2;*CMN
+        joined = ''
+        for cmdS in cmdL:
+            cmdS = cmdS.strip().lstrip(':')
+            if joined: joined = joined + (';' if cmdS[0]=='*' else ';:')
+            joined = joined + cmdS
+        return joined
+
+    @contextmanager
+    def buffered(self):
+        # coalesce all cmd()s inside the block into one write, sent on leaving the outermost block
+        # or before the next query, whichever comes first
+        self._bufDepth += 1
+        try:
+            yield self
+        finally:
+            self._bufDepth -= 1
+            if not self._bufDepth: self.flush()
+
+    def flush(self):
+        # send the queued commands as one message
+        if not self._cmdL: return
+        cmdS, wait = self._joinCmds(self._cmdL), self._cmdWait
+        self._cmdL = []
+        self._cmdWait = 'NONE'
+        self._send(cmdS, wait)
+
+    def waitPolicy(self, cmdS):
+        # strongest policy over the headers of a (possibly compound) command, relative headers with their full path
+        wait = self.defaultWait
+        for header, val in splitSettings(cmdS):
+            nodeL = header.split(':')
+            for pref, pol in self.waitPolicyD.items():
+                prefL = pref.split(':')  # short form nodes, e.g. ACQ:STATE
+                if len(prefL)>len(nodeL) or not all(_nodeMatch(n, p) for n, p in zip(nodeL, prefL)): continue
+                if waitT.index(pol)>waitT.index(wait): wait = pol
+        return wait
+
+    def sync(self, wait='OPC'):
+        # block until the instrument has caught up with what was written, according to wait
+        if wait=='NONE':
+            return
+        elif wait=='WAI':
+            self.write('*WAI\n')
+        elif wait=='SLEEP':
+            self.nap(sleeptime)
+        elif wait=='OPC':
+            t0 = time()
+            self.write('*OPC?\n')
+            self.readline()
+            if self.metrics: self.metrics.waited(time()-t0)
+        elif wait=='BUSY':
+            naptime = 0.001
+            t0 = time()
+            tmo = t0 + self.busyTimeout
+            while self.query_val('BUSY?') != '0':
+                if time() > tmo:
+                    if self.metrics: self.metrics.timedOut()
+                    raise ValueError('Instrument still BUSY after %.1f s'%self.busyTimeout)
+                sleep(naptime)
+                naptime = min(2*naptime, 0.05)
+            if self.metrics: self.metrics.waited(time()-t0)
+        else:
+            raise ValueError('Not a wait policy: %s'%wait)
+
+    def nap(self, seconds):
+        # a fixed delay, accounted as such when metrics are on
+        sleep(seconds)
+        if self.metrics: self.metrics.slept(seconds)
+
+    def enableMetrics(self, metrics=None):
+        # start counting I/O into metrics (a new ScopeMetrics by default) and return it
+        # read/readline/write get wrapped for the byte counts, everything else checks self.metrics
+        if self.metrics is None:
+            self._rawIO = (self.write, self.read, self.readline)
+            write, read, readline = self._rawIO
+            def mwrite(data):
+                return self.metrics.io(write, (data,), len(data), None)
+            def mread(length):
+                return self.metrics.io(read, (length,), 0, length)
+            def mreadline():
+                return self.metrics.io(readline, (), 0, '\n')
+            self.write, self.read, self.readline = mwrite, mread, mreadline
+        self.metrics = metrics or ScopeMetrics()
+        return self.metrics
+
+    def disableMetrics(self):
+        if self.metrics is None: return
+        self.write, self.read, self.readline = self._rawIO
+        self.metrics = None
+
+    @contextmanager
+    def profile(self):
+        # count everything in the block into a fresh ScopeMetrics, e.g.
+        #   with scope.profile() as m:
+        #       scope.acquire({1: ('FREQ',)})
+        #   print '\n'.join(m.report())
+        prev = self.metrics
+        m = self.enableMetrics(ScopeMetrics())
+        try:
+            yield m
+        finally:
+            m.stop()
+            if prev is None:
+                self.disableMetrics()
+            else:
+                self.metrics = prev
+
+    def invalidateWfm(self, chN=None):
+        # drop cached preambles, e.g. after someone turned a knob on the front panel
+        chL = self._channelL if chN is None else (self.getChannel(chN),)
+        for chan in chL:
+            chan.invalidate()
+
+    def _wfmWrite(self, cmdS):
+        # invalidate the cached preambles that a (possibly compound) command touches
+        # relative headers (DATA:SOURCE CH1;ENCDG RPB) count with their full path, as in _shadowWrite
+        for header, val in splitSettings(cmdS):
+            if header[-1]=='?': continue
+            keyL = header.split(':')
+            root = keyL[0]
+            if root[:2]=='CH' and root[2:].isdigit():
+                self.invalidateWfm(int(root[2:]))
+            elif root.startswith(self._wfmAllT):
+                self.invalidateWfm()
+            else:
+                for pref, subT in self._wfmSubD.items():
+                    if root.startswith(pref) and len(keyL)>1 and keyL[1].startswith(subT):
+                        self.invalidateWfm()
+
+    def _shadowWrite(self, cmdS):
+        # keep the shadow state (trigger _trigD, horizontal _horD, channel chD) current with what we write
+        for header, val in splitSettings(cmdS):
+            if header[-1]=='?': continue
+            root = header.split(':')[0]
+            if root.startswith(self._resetT):
+                self._clearShadow()
+            elif root[:2]=='CH' and root[2:].isdigit():
+                chan = self.getChannel(int(root[2:]))
+                chan.chD.update( pickSettings([(header, val)], chan.chFuncD, (root,)) )
+            elif _nodeMatch(root, 'TRIG'):
+                trig = self._triggerCtl
+                trig._trigD.update( pickSettings([(header, val)], trig.trigFuncD, ('TRIG', 'MAI')) )
+            elif _nodeMatch(root, 'HOR'):
+                hor = self._horCtl
+                hor._horD.update( pickSettings([(header, val)], hor.horFuncD) )
+            elif _nodeMatch(root, 'DAT'):
+                nodeL = header.split(':')
+                if len(nodeL)==2 and _nodeMatch(nodeL[1], 'STAR'): self._dataStart = int(val)
+                if len(nodeL)==2 and _nodeMatch(nodeL[1], 'STOP'): self._dataStop = int(val)
+
+    def _clearShadow(self):
+        self._dataStart = self._dataStop = None  # a recalled setup may have its own, read again when needed
+        self._measCtl._slotL = []  # and its own measurement slots, configured again on the next acqMeas()
+        self._triggerCtl._trigD.clear()
+        self._horCtl._horD.clear()
+        for chan in self._channelL:
+            chan.chD.clear()
+
+    def _subsystem(self, sub):
+        # (control, its settings dict) for a shadow() key
+        if sub=='TRIG': return self._triggerCtl, self._triggerCtl._trigD
+        if sub=='HOR': return self._horCtl, self._horCtl._horD
+        chan = self.getChannel(sub)
+        return chan, chan.chD
+
+    def shadow(self):
+        # what we believe the instrument is set to: seeded by snapshot(), kept current by every cmd()
+        # {'TRIG': {'LEVEL': 4.56, ...}, 'HOR': {'HOR:MAIN:SCA': 0.05, ...}, 1: {'SCA': 0.5, ...}, ...}
+        shD = {'TRIG': dict(self._triggerCtl._trigD), 'HOR': dict(self._horCtl._horD)}
+        for i, chan in enumerate(self._channelL):
+            shD[i+1] = dict(chan.chD)
+        return shD
+
+    def apply(self, confD):
+        # bring the instrument to confD (shaped like shadow()), sending only what differs, in one message
+        # query only keys (the trigger STATE) are status, not settings, and are skipped
+        # returns the (subsystem, key, value) settings that were actually sent
+        sentL = []
+        with self.buffered():
+            for sub, setD in confD.items():
+                ctl, shD = self._subsystem(sub)
+                for key, val in setD.items():
+                    if key in ctl.queryOnlyT: continue
+                    if val is None or sameSetting(shD.get(key), val): continue
+                    ctl[key] = val
+                    sentL.append( (sub, key, val) )
+        return sentL
 
     def prepare(self):
-        self.cmd('acquire:state on')
-        raw_input('Press ENTER when ready to acquire triggered data: ')
+        # arm a single sequence and wait for it to trigger
+        self.arm()
+        self.waitAcq()
+
+    def srqCapable(self):
+        # can the link deliver service requests? see waitSRQ
+        return False
+
+    def waitSRQ(self, timeout):
+        # block until the instrument requests service: True, False on timeout, None if the link can't tell
+        return None
+
+    def arm(self):
+        # start a single sequence acquisition. where the link delivers service requests its completion
+        # raises one: *OPC sets ESR bit 0 (OPC) once the sequence is done (table 2-30), *ESE 1 passes that
+        # on to the status byte ESB bit, *SRE 32 turns ESB into an SRQ
+        with self.buffered():
+            if self.srqCapable():
+                if not self._srqOn: self.cmd('*ESE 1;*SRE 32')
+                self._srqOn = True
+                self.cmd('*CLS')
+            self.cmd('ACQ:STOPA SEQ')
+            self.cmd('ACQ:STATE ON')
+            if self._srqOn: self.cmd('*OPC')
+
+    def waitAcq(self, timeout=None, stop=None):
+        # block until the sequence started by arm() has completed, returns the seconds waited
+        # waits on the service request where there is one, otherwise polls ACQ:STATE? (0 once the sequence
+        # is done) with a backoff that starts near the previous wait, so a steady trigger costs a poll or two
+        # stop: a threading.Event that ends the wait early, within stopPoll seconds; None is returned then
+        if timeout is None: timeout = self.acqTimeout
+        nap = stop.wait if stop else sleep
+        stopped = stop.is_set if stop else lambda: False
+        t0 = time()
+        done = None
+        if self._srqOn:
+            # in slices a stop can get in between
+            while 1:
+                left = max(0.0, timeout-(time()-t0))
+                done = self.waitSRQ(min(left, self.stopPoll) if stop else left)
+                if done is not False or stopped() or not left: break
+        if done is None:
+            if self._acqEst > 2*self.pollMin: nap(min(0.8*self._acqEst, timeout))
+            naptime = self.pollMin
+            while not stopped() and self.query_val('ACQ:STATE?') not in ('0', 'OFF'):
+                if time()-t0 > timeout:
+                    done = False
+                    break
+                nap(naptime)
+                naptime = min(1.5*naptime, self.pollMax)
+            else:
+                done = True
+        if self.metrics: self.metrics.waited(time()-t0)
+        if stopped(): return None
+        if not done:
+            # READY: armed, no trigger came
+            if self.metrics: self.metrics.timedOut()
+            raise ValueError('No acquisition after %.1f s, TRIG:STATE %s'%(timeout, self.query_val('TRIG:STATE?')))
+        dt = time()-t0
+        self._acqEst = 0.7*self._acqEst + 0.3*dt if self._acqEst else dt
+        self._measCtl.stale()  # the measurement slots still show the previous record
+        return dt
 
     def complete(self):
         self.cmd('acquire:state off')
 
     # should catch SIGINT/SIGKILL and call __del__ and clean up buffers
-    __del__ = complete
+    def __del__(self):
+        self.closeStore()  # dump()ed captures still waiting for a full chunk
+        self.complete()
 
-    def acquire(self, chmD, prepChannels=True):
+    def readWindow(self):
+        # DATa:STARt/STOP as the instrument has them now, into the shadow setWindow() compares against
+        self._shadowWrite(self.query('DATA:STAR?;STOP?'))
+        return self._dataStart, self._dataStop
+
+    def setWindow(self, start=1, stop=None):
+        # transfer only record points start..stop (1-based, inclusive; DATa:STARt/STOP), stop None: to the end
+        # the preambles follow, and Waveform.time/Channel.divAxis keep the points where they were in the record
+        if stop is None: stop = self.recordLength
+        start, stop = max(1, int(start)), min(self.recordLength, int(stop))
+        if stop < start: raise ValueError('Empty window %d..%d'%(start, stop))
+        with self.buffered():
+            if start != self._dataStart: self.cmd('DATA:START %d'%start)
+            if stop != self._dataStop: self.cmd('DATA:STOP %d'%stop)
+
+    def timeWindow(self, t0, t1, chN=None):
+        # the (start, stop) points covering t0..t1 seconds from the trigger, from a channel's preamble
+        chan = self.getChannel(chN or 1)
+        if not chan._wfmValid:
+            self.cmd('DATA:SOURCE %3s'%chan._channel)
+            chan.wfmpreQ()
+        xzero, xincr = chan.wfmD['XZERO'], chan.wfmD['XINCR']
+        return int(floor((t0-xzero)/xincr))+1, int(ceil((t1-xzero)/xincr))+1
+
+    def acquire(self, chmD, prepChannels=True, window=None, twindow=None):
+        # window: (start, stop) record points, twindow: (t0, t1) seconds from the trigger, default the whole record
+        # the scope is left running or stopped as it was found
+        if twindow is not None: window = self.timeWindow(twindow[0], twindow[1], min(chmD.keys()))
+        self.setWindow(*(window or ()))
         self._triggerCtl.acqSettings()
-        self.prepare()
-        self.getSweepSetting()
-        self._chanAcqL=chmD.keys()
+        prevAcq = self.getAcqState()
+        try:
+            self.prepare()
+            self._acqT = time()
+            self.getSweepSetting()
+            self._chanAcqL=chmD.keys()
+            if not self.hostMeas: self.acqMeas(chmD, immed=True)  # the record is stopped, no slot refresh to wait for
+            for ch,m in chmD.items():
+                chan = self.getChannel(ch)
+                chan.getVerticalSetting()
+                chan.acquire(prepChannels)
+            if self.hostMeas: self.acqMeasHost(chmD)
+        finally:
+            self.setAcqState(*prevAcq)
+
+    def stream(self, chmD, capacity=64, policy='DROP', single=True, maxCaptures=None):
+        # unattended back to back captures of the channels in chmD ({chN: measurement list}), e.g.
+        #   with scope.stream({1: ('FREQ',), 2: ()}, policy='BLOCK') as st:
+        #       for rec in st:
+        #           store(rec.t, rec.chN, rec.codes, rec.wfmD, rec.measD)
+        # see TraceStream and TraceRing
+        return TraceStream(self, chmD, capacity, policy, single, maxCaptures)
+
+    def sequence(self, chNL, n=None):
+        # n (or endless) triggered captures of the channels in chNL as fast as the trigger and link allow, e.g.
+        #   loop = scope.sequence((1, 2), 1000)
+        #   for recL in loop:
+        #       edges.append(crossing(recL[0].trace()))
+        #   print loop.stats()
+        # see SequenceLoop
+        return SequenceLoop(self, chNL, n)
+
+    def accumulate(self, chNL, n, ema=None, accD=None):
+        # point by point mean, std, min, max (and EMA) over n captures of the channels in chNL, see traceaccum.py
+        # accD: {chN: TraceAccumulator} to carry on with; returns it
+        from traceaccum import TraceAccumulator
+        accD = accD or dict( (chN, TraceAccumulator(ema=ema)) for chN in chNL )
+        for recL in self.sequence(chNL, n):
+            for rec in recL:
+                accD[rec.chN].add(rec)
+        return accD
+
+    def acqMeas(self, chmD, immed=False):
+        # measurements for all channels in one batch, see MeasurementControl. returns {chN: {typ: val}}
+        # immed: all through MEASUrement:IMMed (MeasurementControl.immed), for a record that no longer changes
+        valD = self._measCtl.immed(chmD) if immed else self._measCtl(chmD)
         for ch,m in chmD.items():
-            chan = self.getChannel(ch)
-            chan.getVerticalSetting()
-            chan.acqMeas(m)
-            chan.acquire(prepChannels)
-        self.complete()
-
-    def measLoop(self, chmD):
+            self.getChannel(ch).acqMeas(m, valD[ch])
+        return valD
+
+    def acqMeasHost(self, chmD):
+        # the same measurements from the acquired traces, all channels in one vectorized batch
+        # (they share the time base); PHAS is against phaseRef, if that channel was acquired
+        valD = self.hostMeasure(chmD, dict( (ch, self.getChannel(ch).wfm) for ch in chmD ))
+        for ch in chmD:
+            self.getChannel(ch).acqMeas(chmD[ch], valD[ch])
+
+    def hostMeasure(self, chmD, wfmD):
+        # {chN: {typ: val}} for the types in chmD worked out from the Waveforms in wfmD ({chN: Waveform}),
+        # undefined values as mNAN
+        chNL = sorted(chmD.keys())
+        typL = sorted(set( typ.upper() for mL in chmD.values() for typ in mL ))
+        traceL = [ wfmD[ch].volts for ch in chNL ]
+        refV = wfmD[self.phaseRef].volts if self.phaseRef in chNL else None
+        resD = measureBatch(traceL, wfmD[chNL[0]].xincr, typL, refV) if typL else {}
+        return dict( (ch, dict( (typ, mNAN if isnan(val[i]) else val[i]) for typ, val in resD.items() ))
+                     for i, ch in enumerate(chNL) )
+
+    def measLoop(self, chmD, n=None, log=None, window=None, every=1.0):
+        # acqMeas() over and over into a MeasLog (see measlog.py, made here unless given), printing the rolling
+        # statistics over window samples every `every` seconds (None: quietly). n iterations, or until ^C.
+        # window defaults to 100, or to the first window of a log given; it has to be one of that log's windows
+        # slot readings come at the rate the display refreshes them, see MeasurementControl. returns the log
+        from measlog import MeasLog
+        if log is None:
+            window = window or 100
+            log = MeasLog([ (ch, typ) for ch in sorted(chmD.keys()) for typ in chmD[ch] ], windowL=(window,))
+        elif window is None:
+            window = log.windowL[0] if log.windowL else None
+        elif window not in log.windowL:
+            raise ValueError('The log has no %d sample window (%s)'%(window, ', '.join(map(str, log.windowL))))
         debug=self._debug
         self._debug=False
-        while 1:
-            for ch,m in chmD.items():
-                chan = self.getChannel(ch)
-                chan.acqMeas(m)
-                print chan.getMeasStrD()
-            x = raw_input('Enter to continue, anything to quit: ')
-            if x: break
-        self._debug=debug
-
-    def load(self):
-        pass
-
-    def dump(self):
-        dfp = open('scope.dat', 'w')
-        dfp.close()
+        shown = time()
+        try:
+            while n is None or log.n < n:
+                log.append(self.acqMeas(chmD))
+                if every is not None and time()-shown >= every:
+                    print '\n'.join(log.format(window))
+                    shown = time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._debug=debug
+        return log
+
+    def _openStore(self, path, mode):
+        # the trace store at path (storePath), kept open between calls
+        from tracestore import TraceStore
+        path = path or self.storePath
+        store = getattr(self, '_store', None)
+        if store is None or store.path != path or store.mode != mode:
+            if store is not None: store.close()
+            store = self._store = TraceStore(path, mode)
+        return store
+
+    def closeStore(self):
+        # write out what dump() has buffered and close the trace store
+        store = getattr(self, '_store', None)
+        if store is not None: store.close()
+        self._store = None
+
+    def display(self, idStr=None, disp=True, save=True, backend=None):
+        # a ScopeDisplay of the last acquire(); plotter and matplotlib are imported on the first call
+        # backend: matplotlib backend to switch to, e.g. 'TkAgg' (works best for annotate/save) or 'Agg',
+        # otherwise whatever matplotlibrc/MPLBACKEND says
+        if backend:
+            import matplotlib
+            if 'matplotlib.pyplot' in sys.modules:
+                sys.modules['matplotlib.pyplot'].switch_backend(backend)
+            else:
+                matplotlib.use(backend)  # before plotter imports pyplot, which would load the rc backend
+        from plotter import ScopeDisplay
+        if idStr is None: idStr = datetime.datetime.now().isoformat().replace(':', '-').split('.')[0]
+        return ScopeDisplay(self, idStr, disp, save)
+
+    def dump(self, path=None):
+        # append the channels of the last acquire() to the trace store, see tracestore.py
+        # the store writes a chunk once chunkRecords records are waiting, and the rest on closeStore() or load()
+        # returns the capture number in the store
+        store = self._openStore(path, 'a')
+        recL = []
+        for chN in sorted(self._chanAcqL):
+            chan = self.getChannel(chN)
+            msmnt = chan._msmnt
+            measD = OrderedDict( (m, getattr(msmnt, m.lower())) for m in msmnt.measL )
+            recL.append( TraceRecord(self._acqT, 0, chN, chan.codes, dict(chan.wfmD), measD, chan.voltsdiv) )
+        return store.appendCapture(recL, dict(self._triggerCtl._trigD))
+
+    def load(self, capN=-1, path=None):
+        # put capture capN (negative counts from the end) of the trace store back in the channels, as acquire()
+        # would have left them. only the index and the one chunk holding the capture are read
+        recL = self._openStore(path, 'r').capture(capN)
+        for rec in recL:
+            self.getChannel(rec.chN).loadRecord(rec)
+        self._chanAcqL = [rec.chN for rec in recL]
+        self._acqT = recL[0].t
+        self.setSweep(recL[0].wfmD['XINCR']*self.recordLength/10.0)  # NR_PT is only the window's points
+        return recL
         
     def getSweepSetting(self):
-        sufD = {3:'m', 6:'u', 9:'n'}
-        scaled=self.query_float('hor:mai:sca?')
-        if scaled >= 1:
-            suf = ' s'
-        if scaled < 1:
-            mulmod =3 * ceil( log10(1.0/scaled)  / 3)            
-            scaled = scaled*10**mulmod
-            suf = sufD[mulmod]+'s'
-        sweepStr= '%.f' % scaled
-        self.sweepStr = sweepStr + '\n' + (suf) + "/DIV"
-        self.sweep=scaled
+        self.setSweep( self.query_float('hor:mai:sca?') )
+
+    def setSweep(self, scaled):
+        self.sweepStr, self.sweep = sweepString(scaled)
 
     def showFileSystem(self):
         print self.query('FILES:DIR?')
@@ -510,23 +1719,94 @@ class TektronixScope(object):
         
 class TDS2024(TektronixScope):
     _idStr = 'TEKTRONIX,TDS 2024,0,CF:91.1CT FV:v4.12 TDS2CM:CMV:v1.04'
+    _nMeasSlots = 5
 
-    def __init__(self, port='/dev/ttyS0', **kwD):
+    baudT = (19200, 9600, 4800, 2400, 1200, 600, 300)  # RS232:BAUd, fastest first
+    baudSettle = 0.1  # the scope drops the first characters sent right after RS232:BAUd
+
+    def __init__(self, port='/dev/ttyS0', baud=9600, rtscts=False, negotiate=False, **kwD):
+        # baud/rtscts have to match what the scope is set to now, negotiate=True then speeds up the link
         self._port = port
-        super(TDS2024, self).__init__(kwD)
+        self._baud = baud
+        self._rtscts = rtscts
+        self.bytesPerSec = None
+        super(TDS2024, self).__init__(**kwD)
+        if negotiate: self.negotiate()
 
     def connect(self):
-        self.serial = Serial(self._port, 9600, timeout=None)
+        # pyserial 2 names throughout (writeTimeout, flushInput, sendBreak, ...), 3.x still answers to them
+        self.serial = Serial(self._port, self._baud, timeout=None, rtscts=self._rtscts)
         self.read = self.serial.read
         self.readline = self.serial.readline
         self.write = self.serial.write
 
+    def negotiate(self, maxBaud=None):
+        # switch the link to the fastest rate both ends support, with hard flagging (RTS/CTS) on both ends
+        # every step is checked with *IDN?, falling back to the last rate that worked
+        # returns the achieved bytes/second
+        self.flush()
+        self.cmd('RS232:HARDF ON')
+        self.serial.flush()
+        self.serial.rtscts = True
+        if not self._verify():
+            # no RTS/CTS on this cable: with no CTS the host can't send while it flags, so it stops first. the
+            # scope still takes the command, flagging only holds back what it sends, then the link has to work again
+            self.serial.rtscts = False
+            self.cmd('RS232:HARDF OFF', wait='NONE')
+            self.serial.flush()
+            if not self._verify():
+                raise ValueError('Lost the RS232 link turning hard flagging back off')
+            if self._debug: print 'no RTS/CTS on this cable, staying without flow control'
+        for baud in self.baudT:
+            if maxBaud and baud>maxBaud: continue
+            if baud not in self.serial.BAUDRATES: continue
+            if baud==self.serial.baudrate or self._setBaud(baud): break
+        if self._debug: print 'RS232 link at %d baud'%self.serial.baudrate
+        return self.measureRate()
+
+    def _setBaud(self, baud):
+        # move both ends to baud, back to where we were if *IDN? doesn't come through
+        prev = self.serial.baudrate
+        for rate in (baud, prev):
+            self.cmd('RS232:BAUD %d'%rate, wait='NONE')
+            self.serial.flush()  # out of the UART before we change its rate
+            self.nap(self.baudSettle)
+            self.serial.baudrate = rate
+            if self._verify():
+                self._baud = rate
+                return rate==baud
+        raise ValueError('Lost the RS232 link switching from %d to %d baud'%(prev, baud))
+
+    def _verify(self):
+        # does the link work as set? *IDN? has to come back intact. a write held up by a CTS that never comes
+        # times out as well, and what it couldn't send is thrown away
+        self.serial.timeout = 1
+        self.serial.writeTimeout = 1
+        try:
+            self.serial.flushInput()
+            self.write('*IDN?\n')
+            return self.readline().strip() == self._idStr
+        except SerialTimeoutException:
+            self.serial.flushOutput()
+            return False
+        finally:
+            self.serial.timeout = None
+            self.serial.writeTimeout = None
+
+    def measureRate(self):
+        # bytes/second for a long reply (SET?), round trip included
+        t0 = time()
+        resp = self.query('SET?')
+        self.bytesPerSec = len(resp)/(time()-t0)
+        if self._debug: print '%d bytes in at %.0f bytes/s (%.0f nominal)'%(len(resp), self.bytesPerSec, self.serial.baudrate/10.)
+        return self.bytesPerSec
+
     def clear(self):
         cnt=10
         self.serial.timeout=1
         while 1:
             self.serial.sendBreak() # doesnt seem to handle if other stuff in the queue
-            sleep(sleeptime)
+            self.nap(sleeptime)
             resp=self.readline()
             if resp == 'DCL\0\n':   #  should see: [68, 67, 76, 0, 10]
                 # we may have another DCL in the queue because we've repeated
@@ -618,87 +1898,218 @@ Device Status:     0x0000
 
     """
     _idStr = 'TEKTRONIX,TDS 2024C,C016676,CF:91.1CT FV:v24.17'
+    _nMeasSlots = 5
+    readSize = 4096  # smallest transfer we ask for, one covers most replies and a whole 1 byte CURVE
     
     def __init__(self, port='/dev/usbtmc0', **kwD):
+        # port is the usbtmc kernel driver device, or None to speak USBTMC ourselves through PyUSB
         self._port = port
-        super(USBScope, self).__init__(kwD)
+        self._rbuf = ''
+        super(USBScope, self).__init__(**kwD)
 
     def connect(self):
-        self.usbtmc = os.open(self._port, os.O_RDWR)
+        if self._port:
+            self._link = USBTMCKernel(self._port)
+        else:
+            self._link = USBTMCBulk()
         #instr = usbtmc.Instrument(idVendor=0x0699, idProduct=0x03a6)
         self.write('HEADER on\n')
 
     def write(self, data):
-        os.write(self.usbtmc, data)
+        self._link.write(data)
 
-    def read(self, length = 4000):
-        return os.read(self.usbtmc, length)
+    def _fill(self, want):
+        # one transfer into the receive buffer, sized for what we expect but at least readSize
+        data = self._link.read(max(want, self.readSize))
+        self._rbuf = self._rbuf + data
+        return data
+
+    def read(self, length):
+        while len(self._rbuf) < length:
+            if not self._fill(length-len(self._rbuf)): break
+        data, self._rbuf = self._rbuf[:length], self._rbuf[length:]
+        return data
 
     def readline(self):
-        return self.read() #.strip() 
+        start = 0
+        while 1:
+            i = self._rbuf.find('\n', start)
+            if i >= 0: break
+            start = len(self._rbuf)
+            if not self._fill(0):
+                i = len(self._rbuf)-1
+                break
+        data, self._rbuf = self._rbuf[:i+1], self._rbuf[i+1:]
+        return data
+
+    def srqCapable(self):
+        return self._link.srqCapable
 
-    def _readline(self):
-        buf = ''
-        new = self.read(1)
-        while new != '\n':
-            buf = buf+new
-            new=self.read(1)
-        return buf
+    def waitSRQ(self, timeout):
+        return self._link.waitSRQ(timeout)
 
-    def usb(self):
+    def clear(self):
         """
-        USB End of Message (EOM) Terminators. The EOM bit must be set in
-        the USB header of the last transfer of a command message. See the
-        USB Test and Measurement Class Specification (USBTMC) section
-        3.2.1 for details. The oscilloscope terminates messages by setting
-        the EOM bit in the USB header of the last transfer of a message to
-        the host (USBTMC Specification section 3.3.1), and by terminating
-        messages with a LF. White space is allowed before the terminator;
-        for example, CR LF is acceptable.
+        From a USB host, send an INITIATE_CLEAR followed by a
+        CHECK_CLEAR_STATUS. The USB interface responds to
+        CHECK_CLEAR_STATUS with STATUS_SUCCESS when it is
+        finished clearing the output queue.
         """
+        self._link.clear()
+        self._rbuf = ''
+
+class USBTMCKernel(object):
+    # the linux usbtmc kernel driver does the USBTMC headers, each read() is one REQUEST_DEV_DEP_MSG_IN
+    USBTMC_IOCTL_CLEAR = 0x5b02  # _IO('[', 2)
+    USBTMC488_IOCTL_WAIT_SRQ = 0x40045b17  # _IOW('[', 23, __u32), linux 5.0 and later
+    srqCapable = True  # until the driver tells us otherwise
+
+    def __init__(self, port):
+        self.usbtmc = os.open(port, os.O_RDWR)
+
+    def write(self, data):
+        os.write(self.usbtmc, data)
+
+    def read(self, size):
+        return os.read(self.usbtmc, size)
+
+    def clear(self):
+        # the driver runs INITIATE_CLEAR/CHECK_CLEAR_STATUS and clears the Bulk-OUT halt for us
+        from fcntl import ioctl  # linux only, like the driver
+        ioctl(self.usbtmc, self.USBTMC_IOCTL_CLEAR)
+
+    def waitSRQ(self, timeout):
+        # the driver watches the interrupt endpoint for us, timeout in ms
+        if not self.srqCapable: return None
+        from fcntl import ioctl
+        try:
+            ioctl(self.usbtmc, self.USBTMC488_IOCTL_WAIT_SRQ, pack('I', int(1000*timeout)))
+        except IOError, e:
+            if e.errno == errno.ETIMEDOUT: return False
+            if e.errno in (errno.ENOTTY, errno.EINVAL):  # older driver
+                self.srqCapable = False
+                return None
+            raise
+        return True
+
+class USBTMCBulk(object):
+    """
+    USBTMC 1.0 over PyUSB, talking to the bulk endpoints ourselves: every transfer carries the 12 byte
+    Bulk-OUT/Bulk-IN header (USBTMC section 3.2/3.3), padded to a multiple of 4 bytes.
+
+    USB End of Message (EOM) Terminators. The EOM bit must be set in
+    the USB header of the last transfer of a command message. See the
+    USB Test and Measurement Class Specification (USBTMC) section
+    3.2.1 for details. The oscilloscope terminates messages by setting
+    the EOM bit in the USB header of the last transfer of a message to
+    the host (USBTMC Specification section 3.3.1), and by terminating
+    messages with a LF. White space is allowed before the terminator;
+    for example, CR LF is acceptable.
+    """
+    DEV_DEP_MSG_OUT = 1
+    REQUEST_DEV_DEP_MSG_IN = 2
+    DEV_DEP_MSG_IN = 2
+    INITIATE_CLEAR = 5
+    CHECK_CLEAR_STATUS = 6
+    STATUS_SUCCESS = 1
+    STATUS_PENDING = 2
+    SRQ_NOTIFY = 0x81  # USB488 interrupt IN bNotify1 of a service request, bNotify2 is the status byte
+
+    def __init__(self, idVendor=0x0699, idProduct=0x03a6, timeout=5000):
+        try:
+            import usb.core
+            import usb.util
+        except ImportError:
+            print 'No PyUSB'
+            raise
+        self.timeout = timeout # ms
 
-    try:
-        import usb.core
-        import usb.util
-    except:
-        print 'No PyUSB'
-        raise
-        
         # find our device
-        dev = usb.core.find(idVendor=0x0699, idProduct=0x03a6)
-        
-        # was it found?
+        dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
         if dev is None:
             raise ValueError('Device not found')
-        
+        try:
+            if dev.is_kernel_driver_active(0): dev.detach_kernel_driver(0) # usbtmc module has it
+        except NotImplementedError:
+            pass
         # set the active configuration. With no arguments, the first
         # configuration will be the active one
         dev.set_configuration()
-        
-        # get an endpoint instance
-        cfg = dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        
-        ep = usb.util.find_descriptor(
-            intf,
-            # match the first OUT endpoint
-            custom_match = lambda e: usb.util.endpoint_direction(e.bEndpointAddress) ==  usb.util.ENDPOINT_OUT
-        )
-        
-        assert ep is not None
-        
-        self.read = ep.read
-        self.readline = self._readline
-        self.write = ep.write
+        intf = dev.get_active_configuration()[(0,0)]
+        self.dev = dev
+        self.intfN = intf.bInterfaceNumber
+
+        def endpoint(direction, typ):
+            return usb.util.find_descriptor(intf, custom_match = lambda e: 
+                usb.util.endpoint_direction(e.bEndpointAddress) == direction and usb.util.endpoint_type(e.bmAttributes) == typ)
+        self.epOut = endpoint(usb.util.ENDPOINT_OUT, usb.util.ENDPOINT_TYPE_BULK)   # EP 6
+        self.epIn = endpoint(usb.util.ENDPOINT_IN, usb.util.ENDPOINT_TYPE_BULK)     # EP 5
+        self.epIntr = endpoint(usb.util.ENDPOINT_IN, usb.util.ENDPOINT_TYPE_INTR)   # EP 7, may be None
+        if self.epOut is None or self.epIn is None: raise ValueError('No USBTMC bulk endpoints')
+        self._tag = 0
+
+    def _nextTag(self):
+        # bTag runs 1..255, never 0
+        self._tag = self._tag % 255 + 1
+        return self._tag
+
+    def write(self, data):
+        # the whole message in one DEV_DEP_MSG_OUT transfer, EOM set
+        tag = self._nextTag()
+        hdr = pack('<BBBxIBxxx', self.DEV_DEP_MSG_OUT, tag, ~tag & 0xff, len(data), 0x01)
+        self.epOut.write(hdr + data + '\0'*(-len(data) % 4), self.timeout)
+
+    def read(self, size):
+        # up to size bytes of the current message, in as few transfers as the device wants to send
+        # stops at EOM, so asking for more than is there never waits on the next message
+        data = ''
+        while len(data) < size:
+            tag = self._nextTag()
+            self.epOut.write(pack('<BBBxIBBxx', self.REQUEST_DEV_DEP_MSG_IN, tag, ~tag & 0xff, size-len(data), 0, 0), self.timeout)
+            buf = self.epIn.read(12 + size-len(data) + 3, self.timeout).tostring()
+            msgID, btag, btagInv, tsize, attr = unpack_from('<BBBxIBxxx', buf)
+            if msgID != self.DEV_DEP_MSG_IN or btag != tag:
+                raise ValueError('Bad USBTMC Bulk-IN header (MsgID %d, bTag %d for %d)'%(msgID, btag, tag))
+            while len(buf) < 12+tsize: # transfer came in pieces
+                buf = buf + self.epIn.read(12+tsize-len(buf)+3, self.timeout).tostring()
+            data = data + buf[12:12+tsize]
+            if attr & 0x01: break  # EOM
+        return data
 
     def clear(self):
-        """
-        From a USB host, send an INITIATE_CLEAR followed by a
-        CHECK_CLEAR_STATUS. The USB interface responds to
-        CHECK_CLEAR_STATUS with STATUS_SUCCESS when it is
-        finished clearing the output queue.
-        """
-        print "Clear() not implemented"
+        # INITIATE_CLEAR, then CHECK_CLEAR_STATUS until done, draining the Bulk-IN FIFO when it says so (4.2.1.6/7)
+        st = self.dev.ctrl_transfer(0xa1, self.INITIATE_CLEAR, 0, self.intfN, 1, self.timeout)
+        if st[0] != self.STATUS_SUCCESS:
+            raise ValueError('INITIATE_CLEAR failed, USBTMC_status %d'%st[0])
+        while 1:
+            st = self.dev.ctrl_transfer(0xa1, self.CHECK_CLEAR_STATUS, 0, self.intfN, 2, self.timeout)
+            if st[0] != self.STATUS_PENDING: break
+            if st[1] & 0x01: # bmClear.D0, read Bulk-IN until a short packet
+                while len(self.epIn.read(self.epIn.wMaxPacketSize, self.timeout)) == self.epIn.wMaxPacketSize: pass
+            else:
+                sleep(sleeptime)
+        if st[0] != self.STATUS_SUCCESS:
+            raise ValueError('CHECK_CLEAR_STATUS failed, USBTMC_status %d'%st[0])
+        self.epOut.clear_halt()
+
+    @property
+    def srqCapable(self):
+        return self.epIntr is not None
+
+    def waitSRQ(self, timeout):
+        # read the interrupt IN endpoint until a service request notification (RQS set) or timeout
+        if self.epIntr is None: return None
+        import usb.core
+        tmo = time() + timeout
+        while 1:
+            left = int(1000*(tmo-time()))
+            if left <= 0: return False  # 0 would mean wait forever
+            try:
+                buf = self.epIntr.read(self.epIntr.wMaxPacketSize, left)
+            except usb.core.USBError, e:
+                if e.errno == errno.ETIMEDOUT: return False
+                raise
+            if len(buf) >= 2 and buf[0] == self.SRQ_NOTIFY and buf[1] & 0x40: return True
 
 if __name__ == '__main__':
     TimeStamp =   datetime.datetime.now().isoformat().replace(':', '-').split('.')[0]
@@ -708,8 +2119,7 @@ if __name__ == '__main__':
     else:
         tds2024=USBScope(port='/dev/usbtmc0', debug=True)
     if 0:
-        from pickle import dump, load
-        # can't pickle the instance. have to try grabbing only attributed ....
+        # the instance can't be pickled, dump() archives the acquired channels instead, see tracestore.py
         acqD =  {3:('FALL', 'RISE', 'PK2P', 'MAXI'), 2: ('FALL', 'RISE', 'MAXI'), 1: ('FALL', 'RISE', 'MAXI') }
         tds2024.acquire(acqD )
         tds2024.dump()
@@ -724,7 +2134,7 @@ if __name__ == '__main__':
         #acqD =  {4:mT, 3: mT, 2:mT, 1: mT}
         acqD =  {1: mT}
         tds2024.acquire(acqD )
-        ScopeDisplay(tds2024, idStr=TimeStamp, disp=True, save=True)
+        tds2024.display(TimeStamp, disp=True, save=True, backend='TkAgg')
 
     if 0:  # options please!!!!
         tds2024.showFileSystem()
@@ -1,5 +1,30 @@
-from tekscope import TektronixScope
-from plotter import ScopeDisplay
+# testscope.py
+# a simulated TDS 2024 that plugs into TektronixScope in place of the serial/USB transport, for
+# testing and benchmarking without an instrument attached.
+#
+# SimInstrument holds the settings, generates triggered captures, CURVE? blocks, WFMPRE? and
+# measurements; DummyScope is the TektronixScope talking to it, optionally over a modelled link, SimSerial an
+# RS232 port and cable to it for TDS2024 itself.
+#
+# the check* functions at the end assert what the layers above the transport should get right: curve decode
+# in every encoding, windows, host measurements, the trace store, the measurement log. python testscope.py
+# runs them, no display needed.
+#
+# the strings below were recorded from a real TDS 2024 session, the simulator answers in the same format.
+
+import os
+import sys
+import shutil
+import tempfile
+from math import floor, log10
+from time import sleep, time
+from numpy import array, arange, pi, sin, clip, rint, int8, int16, where, isnan, allclose, array_equal, nanmean, nanstd, nanmin, nanmax
+from numpy.random import RandomState
+
+from serial import SerialTimeoutException
+
+from tekscope import TektronixScope, TDS2024, sleeptime, splitSettings, sameSetting, _nodeMatch, mNAN, Measurement
+from hostmeas import measureBatch
 
 
 _dicts = """
@@ -97,75 +122,1021 @@ curv?
 got from Serial: [ 4.9   4.94  4.92 ...,  4.94  4.92  4.94]
 
 """
-_reqL = iter( _reqStr[1:-1].split('\n'))
+def _nr3(val):
+    # Tek style <NR3>: 5.0E-1, 4.56E0, 1.400003433E-1
+    if val == 0: return '0.0E0'
+    exp = int(floor(log10(abs(val))))
+    mant = ('%.10f'%(val/10.0**exp)).rstrip('0')
+    if mant[-1]=='.': mant = mant+'0'
+    return '%sE%d'%(mant, exp)
+
+def measure(v, xincr, typ):
+    # what the scope's measurement system would report for the record v, mNAN when it can't
+    # PHAS needs two sources, the TDS 2024 doesn't have it
+    # this is hostmeas itself, so scope against host measurements proves nothing: checkHostMeas uses known values
+    val = measureBatch(v, xincr, (typ,))[typ][0]
+    return mNAN if isnan(val) else val
+
+class SimInstrument(object):
+    """
+    A TDS 2024 in software: stateful settings addressed by short or long SCPI headers, triggered
+    captures of synthetic signals, binary CURVE? blocks with #4NNNN headers and the matching
+    WFMPRE?, MEASUrement:IMMed and MEAS<x> values, and the acquisition states behind ACQ:STATE,
+    TRIG:STATE?, BUSY? and *OPC?.
+
+    signalD maps a channel to a function of time (s, relative to the trigger) returning volts.
+    In RUN mode the scope triggers every trigPeriod seconds; in single SEQuence mode one capture
+    completes trigPeriod after arming.
+    """
+    idStr = 'TEKTRONIX,TDS 2024,0,CF:91.1CT FV:v4.12 TDS2CM:CMV:v1.04'
+    points = 2500
+    trigPeriod = 0.01
+    noise = 0.01  # volts rms
+
+    # canonical long header, default
+    settingT = tuple(
+        [('CH%d:%s'%(ch, key), val) for ch in (1,2,3,4)
+         for key, val in (('SCALE', 1.0), ('POSITION', 0.0), ('COUPLING', 'DC'), ('BANDWIDTH', 'OFF'), ('PROBE', 1.0))] +
+        [('HORIZONTAL:VIEW', 'MAIN'), ('HORIZONTAL:RECORDLENGTH', 2500),
+         ('HORIZONTAL:MAIN:POSITION', 0.0), ('HORIZONTAL:MAIN:SCALE', 5.0e-4),
+         ('TRIGGER:MAIN:MODE', 'AUTO'), ('TRIGGER:MAIN:TYPE', 'EDGE'), ('TRIGGER:MAIN:LEVEL', 0.0),
+         ('TRIGGER:MAIN:HOLDOFF:VALUE', 5.0e-7),
+         ('TRIGGER:MAIN:EDGE:SOURCE', 'CH1'), ('TRIGGER:MAIN:EDGE:COUPLING', 'DC'), ('TRIGGER:MAIN:EDGE:SLOPE', 'RISE'),
+         ('TRIGGER:MAIN:VIDEO:SOURCE', 'CH1'), ('TRIGGER:MAIN:VIDEO:SYNC', 'FIELD'), ('TRIGGER:MAIN:VIDEO:POLARITY', 'NORMAL'),
+         ('ACQUIRE:STATE', 1), ('ACQUIRE:STOPAFTER', 'RUNSTOP'), ('ACQUIRE:MODE', 'SAMPLE'), ('ACQUIRE:NUMAVG', 16),
+         ('DATA:SOURCE', 'CH1'), ('DATA:START', 1), ('DATA:STOP', 2500), ('DATA:ENCDG', 'SRIBINARY'), ('DATA:WIDTH', 1),
+         ('MEASUREMENT:IMMED:TYPE', 'PERIOD'), ('MEASUREMENT:IMMED:SOURCE', 'CH1'),
+         ('HEADER', 1), ('VERBOSE', 1), ('RS232:BAUD', 9600), ('RS232:HARDFLAGGING', 0)] +
+        [('MEASUREMENT:MEAS%d:%s'%(i, key), val) for i in (1,2,3,4,5)
+         for key, val in (('TYPE', 'NONE'), ('SOURCE', 'CH1'))] )
+    # which subsystem query returns what
+    groupD = {'CH1': 'CH1:', 'CH2': 'CH2:', 'CH3': 'CH3:', 'CH4': 'CH4:', 'HORIZONTAL': 'HORIZONTAL:',
+              'TRIGGER': 'TRIGGER:', 'TRIGGER:MAIN': 'TRIGGER:MAIN:', 'DATA': 'DATA:', 'ACQUIRE': 'ACQUIRE:',
+              'RS232': 'RS232:', 'SET': '', '*LRN': ''}
+    # keyword arguments in short form, as the scope accepts them
+    measT = ('FREQUENCY', 'MEAN', 'PERIOD', 'PHASE', 'PK2PK', 'CRMS', 'MINIMUM', 'MAXIMUM', 'RISE', 'FALL', 'PWIDTH', 'NWIDTH', 'NONE')
+
+    def __init__(self, signalD=None, seed=0):
+        self.setD = dict(self.settingT)
+        self._keyL = [ (key.split(':'), key) for key, val in self.settingT ]
+        self.signalD = signalD or {1: lambda t: 2.0*sin(2*pi*1.0e3*t),                   # 1 kHz sine
+                                   2: lambda t: where(sin(2*pi*500*t) >= 0, 5.0, 0.0),   # 500 Hz logic
+                                   3: lambda t: 1.0 + 0.5*((t*2.0e3) % 1.0),            # 2 kHz ramp
+                                   4: lambda t: 0.0*t}
+        self.seed = seed
+        self.unknownL = []  # headers we didn't understand
+        self._capN = 0      # capture counter, frozen while stopped
+        self._capBase = 0
+        self._running = True
+        self._runT = time()
+        self._doneT = None  # end of a pending single sequence
+        self._recD = {}
+        self.ese = self.sre = self.esr = 0  # *ESE, *SRE, event status register
+        self._opcPending = False            # *OPC waiting for the sequence to complete
+
+    # -- settings
+    def _canon(self, header):
+        # canonical long header for a short/long/mixed header, or None
+        nodeL = header.upper().lstrip(':').split(':')
+        for tryL in (nodeL, nodeL+['VALUE']):
+            for keyL, key in self._keyL:
+                if len(keyL)==len(tryL) and all(map(_nodeMatch, tryL, keyL)): return key
+        return None
+
+    def _fmt(self, val):
+        if isinstance(val, float): return _nr3(val)
+        return str(val)
+
+    def _setting(self, key):
+        if self.setD['HEADER'] in (0, '0', 'OFF'): return self._fmt(self.setD[key])
+        return ':%s %s'%(key, self._fmt(self.setD[key]))
+
+    def _set(self, key, val):
+        old = self.setD[key]
+        if isinstance(old, float): val = float(val)
+        elif isinstance(old, int): val = {'ON': 1, 'OFF': 0}.get(val.upper()) if val.upper() in ('ON', 'OFF') else int(float(val))
+        else: val = val.upper().strip('"')
+        if key.startswith('MEASUREMENT') and key.endswith(':TYPE'):
+            val = [m for m in self.measT if _nodeMatch(val, m)][0]
+        self.setD[key] = val
+
+    # -- acquisition
+    def _update(self):
+        now = time()
+        if not self._running: return
+        if self._doneT is not None:
+            if now >= self._doneT:
+                self._running = False
+                self._doneT = None
+                self._capN += 1
+        else:
+            self._capN = self._capBase + int((now - self._runT)/self.trigPeriod)
+
+    def _acqState(self, val):
+        self._update()
+        on = val.upper() in ('ON', 'RUN', '1')
+        if on:
+            self._running = True
+            self._runT = time()
+            self._capBase = self._capN
+            if _nodeMatch(self.setD['ACQUIRE:STOPAFTER'], 'SEQUENCE'):
+                self._doneT = self._runT + self.trigPeriod
+        else:
+            self._running = False
+            self._doneT = None
+
+    def _busy(self):
+        self._update()
+        return self._doneT is not None
+
+    def _events(self):
+        self._update()
+        if self._opcPending and self._doneT is None:
+            self.esr |= 1
+            self._opcPending = False
+
+    def stb(self):
+        # status byte: ESB (bit 5) from the enabled events, MSS/RQS (bit 6) from the enabled summary bits
+        self._events()
+        stb = 0x20 if self.esr & self.ese else 0
+        if stb & self.sre: stb |= 0x40
+        return stb
+
+    def srq(self):
+        return bool(self.stb() & 0x40)
+
+    def _trigState(self):
+        self._update()
+        if self._doneT is not None: return 'READY'
+        if not self._running: return 'SAVE'
+        return 'AUTO' if self.setD['TRIGGER:MAIN:MODE']=='AUTO' else 'TRIGGER'
+
+    def timeAxis(self):
+        scale = self.setD['HORIZONTAL:MAIN:SCALE']
+        xincr = 10.0*scale/self.points
+        xzero = self.setD['HORIZONTAL:MAIN:POSITION'] - 5.0*scale
+        return xzero, xincr
+
+    def record(self, chN):
+        # volts of the current capture, whole record
+        self._update()
+        xzero, xincr = self.timeAxis()
+        key = (self._capN, chN, xzero, xincr)
+        if key not in self._recD:
+            t = xzero + xincr*arange(self.points)
+            rs = RandomState(self.seed + 8*self._capN + chN)
+            self._recD = {key: self.signalD[chN](t) + self.noise*rs.standard_normal(self.points)}
+        return self._recD[key]
+
+    def _codes(self, chN):
+        # digitized record, 25 levels per division, as the scope stores it
+        scale = self.setD['CH%d:SCALE'%chN]
+        pos = self.setD['CH%d:POSITION'%chN]
+        return clip( rint(self.record(chN)/(scale/25.0) + 25.0*pos), -128, 127 )
+
+    def _wfmpre(self):
+        chN = int(self.setD['DATA:SOURCE'][2:])
+        enc = self.setD['DATA:ENCDG']
+        width = self.setD['DATA:WIDTH']
+        scale = self.setD['CH%d:SCALE'%chN]
+        mult = 256 if width==2 else 1
+        ymult = scale/25.0/mult
+        yoff = 25.0*self.setD['CH%d:POSITION'%chN]*mult
+        if 'RP' in enc: yoff = yoff + 128*mult
+        start, stop = self._dataRange()
+        xzero, xincr = self.timeAxis()
+        wfid = '"Ch%d, %s coupling, %s V/div, %s s/div, %d points, Sample mode"'%(
+            chN, self.setD['CH%d:COUPLING'%chN], _nr3(scale), _nr3(self.setD['HORIZONTAL:MAIN:SCALE']), self.points)
+        return ( (('BYT_NR', width), ('BIT_NR', 8*width), ('ENCDG', 'BIN'), ('BN_FMT', 'RP' if 'RP' in enc else 'RI'),
+                  ('BYT_OR', 'LSB' if enc.startswith('S') else 'MSB'), ('NR_PT', stop-start+1), ('WFID', wfid), ('PT_FMT', 'Y'),
+                  ('XINCR', xincr), ('PT_OFF', 0), ('XZERO', xzero), ('XUNIT', '"s"'), ('YMULT', ymult), ('YZERO', 0.0),
+                  ('YOFF', yoff), ('YUNIT', '"Volts"')), chN )
+
+    def _dataRange(self):
+        start = min(max(self.setD['DATA:START'], 1), self.points)
+        stop = min(max(self.setD['DATA:STOP'], start), self.points)
+        return start, stop
+
+    def wfmpre(self):
+        preT, chN = self._wfmpre()
+        return ':WFMPRE:' + ';'.join('%s %s'%(name, self._fmt(val)) for name, val in preT)
+
+    def curve(self):
+        preD, chN = self._wfmpre()
+        preD = dict(preD)
+        start, stop = self._dataRange()
+        codes = self._codes(chN)[start-1:stop]
+        order = '<' if preD['BYT_OR']=='LSB' else '>'
+        if preD['BYT_NR']==2:
+            codes = (codes*256).astype(order+'i2')
+        else:
+            codes = codes.astype(int8)
+        if preD['BN_FMT']=='RP':
+            codes = (codes.astype(int16 if preD['BYT_NR']==1 else '<i4') + (128 if preD['BYT_NR']==1 else 32768)).astype(
+                'u1' if preD['BYT_NR']==1 else order+'u2')
+        block = codes.tostring()
+        nchr = str(len(block))
+        return ':CURVE #%d%s%s'%(len(nchr), nchr, block)
+
+    def measure(self, typ, src):
+        chN = int(src[2:])
+        xzero, xincr = self.timeAxis()
+        typ = [m for m in Measurement.mtypeT if m.startswith(typ[:4])]
+        if not typ: return mNAN
+        return measure(self.record(chN), xincr, typ[0])
+
+    # -- the message exchange
+    def message(self, msg):
+        # handle one program message, return the response message ('' if no queries)
+        respL = []
+        for header, val in splitSettings(msg):
+            if header[-1]=='?':
+                resp = self._query(header[:-1])
+            else:
+                resp = self._command(header, val)
+            if resp is not None: respL.append(resp)
+        return ';'.join(respL)+'\n' if respL else ''
+
+    def _command(self, header, val):
+        if header=='*RST':
+            self.__init__(self.signalD, self.seed)
+        elif header=='*CLS':
+            self.esr = 0
+            self._opcPending = False
+        elif header=='*OPC':
+            self._opcPending = True
+        elif header=='*ESE':
+            self.ese = int(val)
+        elif header=='*SRE':
+            self.sre = int(val)
+        elif header in ('*WAI', 'DCL'):
+            pass
+        else:
+            key = self._canon(header)
+            if key is None:
+                self.unknownL.append(header)
+            elif key=='ACQUIRE:STATE':
+                self._acqState(val)
+            else:
+                self._set(key, val)
+        return None
+
+    def _query(self, header):
+        if header=='*IDN': return self.idStr
+        if header=='*OPC':
+            while self._busy(): sleep(0.0005)
+            return '1'
+        if header=='*ESR':
+            self._events()
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        if header=='*STB': return str(self.stb())
+        if _nodeMatch(header, 'BUSY'): return ':BUSY %d'%self._busy()
+        nodeL = header.split(':')
+        if len(nodeL)==2 and _nodeMatch(nodeL[0], 'ACQUIRE') and _nodeMatch(nodeL[1], 'STATE'):
+            self._update()
+            return ':ACQUIRE:STATE %d'%self._running
+        if len(nodeL)==2 and _nodeMatch(nodeL[0], 'TRIGGER') and _nodeMatch(nodeL[1], 'STATE'):
+            return ':TRIGGER:STATE %s'%self._trigState()
+        if _nodeMatch(header, 'WFMPRE'): return self.wfmpre()
+        if _nodeMatch(header, 'CURVE'): return self.curve()
+        if len(nodeL)==3 and _nodeMatch(nodeL[0], 'MEASUREMENT') and _nodeMatch(nodeL[2], 'VALUE'):
+            slot = 'IMMED' if _nodeMatch(nodeL[1], 'IMMED') else nodeL[1]
+            typ = self.setD['MEASUREMENT:%s:TYPE'%slot]
+            src = self.setD['MEASUREMENT:%s:SOURCE'%slot]
+            return ':MEASUREMENT:%s:VALUE %s'%(slot, _nr3(mNAN if typ=='NONE' else self.measure(typ, src)))
+        for group, pref in self.groupD.items():
+            gL = group.split(':')
+            if len(gL)==len(nodeL) and all(map(_nodeMatch, nodeL, gL)):
+                return ';'.join(self._setting(key) for key, val in self.settingT if key.startswith(pref))
+        key = self._canon(header)
+        if key is None:
+            self.unknownL.append(header+'?')
+            return None
+        return self._setting(key)
 
 class DummyScope(TektronixScope):
-    _idStr = 'Dummy'
-    _rbuf = None
-    _vars = {}
-    while 1:
-        try:
-            kreq = _reqL.next()
-            print kreq, 
-            resp = _reqL.next()
-            print resp
-        except StopIteration:
-            break
-        
-    print 'done'
-    
+    """
+    TektronixScope talking to a SimInstrument. link models the transport: None for instant,
+    'serial'/'serial19200'/'usb', or a (turnaround s, bytes/s) tuple; the delays are real sleeps,
+    so timings measured through a DummyScope resemble the real thing.
+    """
+    _idStr = SimInstrument.idStr
+    _nMeasSlots = 5
+    linkD = {'serial': (0.002, 960.0),        # 9600 baud 8N1
+             'serial19200': (0.002, 1920.0),
+             'usb': (0.0005, 800.0e3)}         # full speed USBTMC, 64 byte packets
+
+    def __init__(self, sim=None, link=None, **kwD):
+        self.sim = sim or SimInstrument()
+        self._linkT = self.linkD.get(link, link)
+        self._rbuf = ''
+        super(DummyScope, self).__init__(**kwD)
+
     def connect(self):
         pass
+
     def clear(self):
-        self._haveCmd = 0
-    def identify(self):
-        pass
-    
-    def read(self):
-        # feed back byte of response
-        byt = self._rbuf[0]
-        if byt!='\n':
-            self._rbuf = self._rbuf[1:]
-        else:
-            self._rbuf=None
-        return byt
-    
+        self._rbuf = ''
+
+    def srqCapable(self):
+        return True
+
+    def waitSRQ(self, timeout):
+        # stands in for the USBTMC interrupt endpoint
+        tmo = time() + timeout
+        while not self.sim.srq():
+            if time() > tmo: return False
+            sleep(0.0005)
+        return True
+
+    def _wire(self, nbytes, turnaround=0.0):
+        if self._linkT:
+            latency, bps = self._linkT
+            sleep(turnaround*latency + nbytes/bps)
+
+    def write(self, buf):
+        self._wire(len(buf), 1)
+        self._rbuf = self._rbuf + self.sim.message(buf)
+
+    def read(self, nBytes):
+        data, self._rbuf = self._rbuf[:nBytes], self._rbuf[nBytes:]
+        self._wire(len(data))
+        return data
+
     def readline(self):
-        # feedback all of response
-        return self.rbuf
-    
-    def _req(self, buf):
-        print 'req: ', buf
-        self._rbuf=''
-        
-    def _cmd(self, key, val):
-        print 'set %s = %s '%(key, val)
-        self._vars[key]=val
-        self._rbuf=None
+        i = self._rbuf.find('\n')+1 or len(self._rbuf)
+        return self.read(i)
+
+class SimSerial(object):
+    """
+    The host end of an RS232 cable to a SimInstrument, with pyserial 2's names. Bytes only get across when both
+    ends run at the same baud rate. cableRTSCTS False: a cable without the handshake lines, so whichever end
+    flags (host rtscts, scope RS232:HARDFlagging ON) never sees CTS and can't send; a blocked host write
+    times out after writeTimeout, and where a real port would hang forever we raise AssertionError instead.
+    """
+    BAUDRATES = (300, 600, 1200, 2400, 4800, 9600, 19200, 38400)
+
+    def __init__(self, sim, baudrate=9600, cableRTSCTS=True):
+        self.sim = sim
+        self.baudrate = baudrate
+        self.cableRTSCTS = cableRTSCTS
+        self.rtscts = False
+        self.timeout = self.writeTimeout = None
+        self._rbuf = ''
+
+    def _linked(self):
+        return self.baudrate == self.sim.setD['RS232:BAUD']
 
     def write(self, buf):
-        buf=buf.strip()
-        if buf[-1]=='?':
-            self._req(buf)
-            return
-        bufL = buf.split(' ')
-        n = len(bufL)
-        if n==2: # set
-            self._cmd(bufL[0], bufL[1])
-            return 
-            
+        if self.rtscts and not self.cableRTSCTS:
+            if self.writeTimeout is None: raise AssertionError('write waits for CTS forever')
+            raise SerialTimeoutException('Write timeout')
+        if not self._linked(): return  # garbled, the scope makes nothing of it
+        resp = self.sim.message(buf)
+        if self.sim.setD['RS232:HARDFLAGGING'] and not self.cableRTSCTS: return  # the scope holds it back
+        if self._linked(): self._rbuf = self._rbuf + resp
+
+    def read(self, size):
+        if len(self._rbuf) < size and self.timeout is None: raise AssertionError('read waits forever')
+        data, self._rbuf = self._rbuf[:size], self._rbuf[size:]
+        return data
+
+    def readline(self):
+        i = self._rbuf.find('\n')+1
+        if not i and self.timeout is None: raise AssertionError('readline waits forever')
+        return self.read(i or len(self._rbuf))
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self._rbuf = ''
+
+    def flushOutput(self):
+        pass
+
+    def sendBreak(self):
+        # the scope answers a break with DCL
+        self._rbuf = 'DCL\0\n' if self._linked() else ''
+
+class SerialScope(TDS2024):
+    # TDS2024 on a SimSerial instead of a serial port
+    baudSettle = 0.0
+
+    def connect(self):
+        self.serial = self._port
+        self.read = self.serial.read
+        self.readline = self.serial.readline
+        self.write = self.serial.write
+
+# -- checks, each raises AssertionError on the first thing wrong
+
+def _quietScope(**kwD):
+    # a DummyScope on a noiseless simulator, so every capture of a channel is the same
+    sim = SimInstrument()
+    sim.noise = 0.0
+    return DummyScope(sim, **kwD)
+
+def checkAccumulate():
+    # running mean, std, min, max and EMA of the captures are numpy's over the stack of them, whether added
+    # one by one or in a batch; a scale change hands the statistics to onReset and starts over
+    from traceaccum import TraceAccumulator
+    sim = SimInstrument()
+    sim.noise = 0.2
+    scope = DummyScope(sim)
+    recL = [recL[0] for recL in scope.sequence((1,), 7)]
+    Y = array([rec.trace() for rec in recL])
+    resetL = []
+    acc = TraceAccumulator(ema=0.3, onReset=lambda acc: resetL.append(acc.stats()))
+    for rec in recL[:3]:
+        acc.add(rec)
+    acc.addBatch(recL[3:])
+    ema = Y[0].copy()
+    for y in Y[1:]:
+        ema += 0.3*(y - ema)
+    assert acc.n == len(Y) and Y.std(0).max() > 0
+    assert allclose(acc.mean, Y.mean(0)) and allclose(acc.std, Y.std(0, ddof=1)) and allclose(acc.ema, ema)
+    assert array_equal(acc.min, Y.min(0)) and array_equal(acc.max, Y.max(0))
+    batch = TraceAccumulator()
+    batch.addBatch(recL)
+    assert allclose(batch.mean, Y.mean(0)) and allclose(batch.std, Y.std(0, ddof=1)) and batch.ema is None
+    scope.cmd('CH1:SCALE 2.0')
+    rec = [recL[0] for recL in scope.sequence((1,), 1)][0]
+    acc.add(rec)
+    assert len(resetL) == 1 and acc.resets == 1 and resetL[0]['n'] == len(Y)
+    assert allclose(resetL[0]['mean'], Y.mean(0))
+    assert acc.n == 1 and allclose(acc.mean, rec.trace()) and allclose(acc.min, acc.max)
+    accD = scope.accumulate((1, 2), 3, ema=0.5)
+    assert sorted(accD) == [1, 2] and all(a.n == 3 and a.resets == 0 for a in accD.values())
+    assert scope.accumulate((1, 2), 2, accD=accD) is accD and accD[2].n == 5
+
+def checkAcqState():
+    # acquire(), sequence() and stream() leave the scope running or stopped as they found it
+    scope = _quietScope()
+    for state, stopAfter in (('RUN', 'RUNSTOP'), ('STOP', 'RUNSTOP'), ('STOP', 'SEQUENCE')):
+        scope.setAcqState(state, stopAfter)
+        scope.acquire({1: ()})
+        assert scope.getAcqState() == (state, stopAfter)
+        for recL in scope.sequence((1,), 2): pass
+        assert scope.getAcqState() == (state, stopAfter)
+        with scope.stream({1: ()}, maxCaptures=2) as st:
+            assert len(list(st)) == 2
+        assert scope.getAcqState() == (state, stopAfter)
+    assert not scope.sim._running
+
+def checkPollAcq():
+    # without service requests (the serial TDS2024) waitAcq() polls ACQ:STATE?: a sequence completes, a
+    # missing trigger times out with the scope back as it was, a stop event ends the wait early
+    import threading
+    class PollScope(DummyScope):
+        def srqCapable(self):
+            return False
+    scope = PollScope()
+    msgL = []
+    message = scope.sim.message
+    def logMessage(msg):
+        msgL.append(msg.upper())
+        return message(msg)
+    scope.sim.message = logMessage
+    scope.sim.trigPeriod = 0.02
+    scope.arm()
+    dt = scope.waitAcq()
+    assert dt >= 0.02 and not scope.sim._running and not scope._srqOn
+    assert not [msg for msg in msgL if '*OPC' in msg or '*SRE' in msg]
+    assert len([msg for msg in msgL if msg.startswith('ACQ:STATE?')]) >= 2
+    scope.sim.trigPeriod, scope.acqTimeout = 10.0, 0.1
+    scope.setAcqState('RUN', 'RUNSTOP')
+    t0 = time()
+    try:
+        scope.acquire({1: ('FREQ',)})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('no timeout without a trigger')
+    assert time()-t0 < 1.0 and scope.getAcqState() == ('RUN', 'RUNSTOP')
+    stop = threading.Event()
+    threading.Timer(0.05, stop.set).start()
+    scope.arm()
+    t0 = time()
+    assert scope.waitAcq(timeout=5.0, stop=stop) is None and time()-t0 < 0.5
+
+def checkPreambleCache():
+    # compound commands with relative headers drop the cached preambles they affect, and only those
+    scope = _quietScope()
+    scope.acquire({1: (), 2: ()})
+    ref = scope.getChannel(1).trace.copy()
+    for cmdS, chL in (('DATA:SOURCE CH1;ENCDG RPBINARY', (1, 2)), ('DATA:SOURCE CH1;START 100', (1, 2)),
+                      ('WFMPRE:ENCDG BIN;BN_FMT RP', (1, 2)), ('ACQ:STATE RUN;MODE SAMPLE', (1, 2)),
+                      ('HEADER 1;:CH2:POSITION 0;SCALE 1.0', (2,)), ('MEASU:IMM:TYP FREQ;SOU CH1', ())):
+        scope.acquire({1: (), 2: ()}, window=(1, 2500))
+        assert scope.getChannel(1)._wfmValid and scope.getChannel(2)._wfmValid
+        scope.cmd(cmdS)
+        assert [ch for ch in (1, 2) if not scope.getChannel(ch)._wfmValid] == list(chL), cmdS
+    scope.acquire({1: ()})
+    scope.cmd('DATA:SOURCE CH1;ENCDG SRIBINARY;START 1')
+    for recL in scope.sequence((1,), 1):
+        assert allclose(recL[0].trace(), ref)
+    scope.cmd('DATA:SOURCE CH1;START 100')
+    for recL in scope.sequence((1,), 1):
+        assert recL[0].wfmD['START'] == scope._dataStart == 100 and allclose(recL[0].trace(), ref[99:])
+
+def checkCoalesce():
+    # cmd()s in a buffered() block, setTrigger() included, go out as one write that the instrument understands;
+    # a buffer that would grow past maxMsgLen goes out first
+    scope = _quietScope()
+    writeL = []
+    write = scope.write
+    def logWrite(buf):
+        writeL.append(buf)
+        write(buf)
+    scope.write = logWrite
+    with scope.buffered():
+        scope.cmd('CH1:SCALE 0.5')
+        scope.cmd('CH2:POSITION 1.0')
+        with scope.buffered():
+            scope.cmd('HOR:MAIN:SCA 1.0E-3')
+        assert writeL == []
+    assert writeL == ['CH1:SCALE 0.5;:CH2:POSITION 1.0;:HOR:MAIN:SCA 1.0E-3\n'], writeL
+    assert scope.sim.setD['CH2:POSITION'] == 1.0 and scope.sim.setD['HORIZONTAL:MAIN:SCALE'] == 1.0e-3
+    del writeL[:]
+    scope.setTrigger(level=0.5, holdo=1.0e-6, mode='NORMAL', typ='EDGE', trigD={'SOU': 'CH2', 'SLO': 'FALL'})
+    assert len(writeL) == 1 and writeL[0].count('TRIGGER:MAIN:') == 6, writeL
+    setD = scope.sim.setD
+    assert (setD['TRIGGER:MAIN:LEVEL'], setD['TRIGGER:MAIN:EDGE:SOURCE'], setD['TRIGGER:MAIN:EDGE:SLOPE']) == (0.5, 'CH2', 'FALL')
+    assert scope.sim.unknownL == []
+    del writeL[:]
+    scope.maxMsgLen = 40
+    with scope.buffered():
+        for ch in (1, 2, 3, 4):
+            scope.cmd('CH%d:POSITION 0.0'%ch)
+    assert writeL == ['CH1:POSITION 0.0;:CH2:POSITION 0.0\n', 'CH3:POSITION 0.0;:CH4:POSITION 0.0\n'], writeL
+    assert all(len(buf) - 1 <= scope.maxMsgLen for buf in writeL)
+
+def checkDecode():
+    # every DATa:ENCdg and width decodes to the same volts as RIBinary at 1 byte
+    scope = _quietScope()
+    scope.acquire({1: ()})
+    chan = scope.getChannel(1)
+    ref, refDiv = chan.trace.copy(), chan.trace_undisplaced.copy()
+    for width in (1, 2):
+        for enc in ('RIBINARY', 'RPBINARY', 'SRIBINARY', 'SRPBINARY'):
+            scope.cmd('DATA:ENCDG %s;WIDTH %d'%(enc, width))
+            chan.acquire(True)
+            assert chan.wfmD['BYT_NR'] == width, (enc, width)
+            assert allclose(chan.trace, ref, rtol=0, atol=1e-9), (enc, width)
+            assert allclose(chan.trace_undisplaced, refDiv, rtol=0, atol=1e-9), (enc, width)
+
+def checkUSBTMC():
+    # Bulk-OUT headers as USBTMC 3.2 has them, Bulk-IN messages put together across transfers and packets,
+    # and USBScope buffering what it was sent past a line or a read
+    from array import array as bytearr
+    from struct import pack, unpack_from
+    from tekscope import USBTMCBulk, USBScope
+    class Endpoints(object):
+        # the bulk endpoints of a device that answers REQUEST_DEV_DEP_MSG_IN with the next of replyL,
+        # (data, EOM) transfers, in 64 byte packets; skew puts the wrong bTag on them
+        def __init__(self, replyL, skew=0):
+            self.replyL, self.skew, self.outL, self.packetL = list(replyL), skew, [], []
+        def write(self, buf, timeout):
+            self.outL.append(buf)
+            if ord(buf[0]) == USBTMCBulk.REQUEST_DEV_DEP_MSG_IN:
+                data, eom = self.replyL.pop(0)
+                tag = (ord(buf[1]) + self.skew) & 0xff
+                msg = pack('<BBBxIBxxx', USBTMCBulk.DEV_DEP_MSG_IN, tag, ~tag & 0xff, len(data), eom)
+                msg = msg + data + '\0'*(-len(data) % 4)
+                self.packetL.extend(msg[i:i+64] for i in range(0, len(msg), 64))
+        def read(self, size, timeout):
+            return bytearr('B', self.packetL.pop(0)[:size])
+    def bulk(replyL=(), skew=0):
+        link = USBTMCBulk.__new__(USBTMCBulk)
+        link.epOut = link.epIn = Endpoints(replyL, skew)
+        link.timeout, link._tag = 100, 0
+        return link
+    link = bulk()
+    link.write('*IDN?\n')
+    buf = link.epOut.outL[-1]
+    assert unpack_from('<BBBxIBxxx', buf) == (1, 1, 0xfe, 6, 1) and buf[12:] == '*IDN?\n\0\0'
+    link._tag = 255
+    link.write('*CLS\n')
+    buf = link.epOut.outL[-1]
+    assert unpack_from('<BBB', buf) == (1, 1, 0xfe) and len(buf) == 20 and buf[17:] == '\0'*3
+    # a message in two transfers, the first longer than a packet; read() stops at EOM
+    link = bulk([('a'*100, 0), ('bc\n', 1)])
+    assert link.read(4096) == 'a'*100 + 'bc\n'
+    reqL = [unpack_from('<BBBxIBBxx', buf) for buf in link.epOut.outL]
+    assert reqL == [(2, 1, 0xfe, 4096, 0, 0), (2, 2, 0xfd, 3996, 0, 0)] and not link.epIn.packetL
+    link = bulk([('x', 1)], skew=1)
+    try:
+        link.read(10)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('wrong bTag accepted')
+    # USBScope reads whole transfers, hands out lines and lengths from what it has
+    class Link(object):
+        def __init__(self, chunkL):
+            self.chunkL, self.sizeL = list(chunkL), []
+        def read(self, size):
+            self.sizeL.append(size)
+            return self.chunkL.pop(0) if self.chunkL else ''
+    class Scope(USBScope):
+        readSize = 4
+        def __init__(self, link):
+            self._rbuf, self._link = '', link
+        def __del__(self):
+            pass
+    scope = Scope(Link(['ab', 'c\nde', 'f\n#3', '123456', '7\n']))
+    assert scope.readline() == 'abc\n' and scope.readline() == 'def\n'
+    assert scope.read(2) == '#3' and scope.read(8) == '1234567\n' and scope.read(1) == ''
+    assert scope._link.sizeL == [4, 4, 4, 8, 4, 4]
+
+def checkWaitPolicy():
+    # every policy fires for the commands it is assigned to, relative headers counted with their full path
+    scope = _quietScope()
+    scope.waitPolicyD = dict(scope.waitPolicyD, **{'ACQ:STATE': 'BUSY', 'DAT:ENC': 'WAI', 'HOR:MAIN:SCA': 'SLEEP'})
+    writeL, napL = [], []
+    write = scope.write
+    def logWrite(buf):
+        writeL.append(buf)
+        write(buf)
+    scope.write, scope.nap = logWrite, napL.append
+    for cmdS, wait, sentL in (('CH1:POSITION 0;SCALE 1.0', 'NONE', ['CH1:POSITION 0;SCALE 1.0\n']),
+                              ('DATA:SOURCE CH1;ENCDG RIBINARY', 'WAI', ['DATA:SOURCE CH1;ENCDG RIBINARY;*WAI\n']),
+                              ('HOR:MAIN:POS 0;SCA 5.0E-4', 'SLEEP', ['HOR:MAIN:POS 0;SCA 5.0E-4\n']),
+                              ('ACQ:MODE SAMPLE;STATE RUN', 'BUSY', ['ACQ:MODE SAMPLE;STATE RUN\n', 'BUSY?\n']),
+                              ('*CLS;*RST', 'OPC', ['*CLS;*RST;*OPC?\n'])):
+        assert scope.waitPolicy(cmdS) == wait, cmdS
+        del writeL[:], napL[:]
+        scope.cmd(cmdS)
+        assert writeL == sentL and napL == ([sleeptime] if wait == 'SLEEP' else []), (cmdS, writeL, napL)
+    # a *WAI command still rides along with the next query
+    del writeL[:]
+    with scope.buffered():
+        scope.cmd('DATA:ENCDG RIBINARY')
+        scope.query('CH1:SCA?')
+    assert writeL == ['DATA:ENCDG RIBINARY;*WAI;:CH1:SCA?\n'], writeL
+
+def checkWindow():
+    # a DATa:STARt/STOP window is the same points, at the same times, as that part of the whole record
+    scope = _quietScope()
+    scope.acquire({1: ()})
+    chan = scope.getChannel(1)
+    volts, t = chan.trace.copy(), chan.wfm.time.copy()
+    scope.acquire({1: ()}, window=(100, 400))
+    assert len(chan.wfm) == 301 and chan.wfmD['START'] == 100
+    assert allclose(chan.trace, volts[99:400]) and allclose(chan.wfm.time, t[99:400])
+    assert allclose(chan.divAxis(), 10.0*arange(99, 400)/scope.recordLength)
+    scope.acquire({1: ()})
+    assert len(chan.wfm) == scope.recordLength
+    # a scope left windowed by an earlier session gets the whole record when asked for it
+    scope.cmd('DATA:START 100;STOP 400')
+    scope = DummyScope(scope.sim)
+    scope.acquire({1: ()})
+    assert len(scope.getChannel(1).wfm) == scope.recordLength and scope.getChannel(1).wfmD['START'] == 1
+
+def checkHostMeas():
+    # measureBatch against what the signals are by construction
+    xincr = 1.0e-5 / 5
+    t = arange(2500)*xincr - 2.5e-3
+    sine = 2.0*sin(2*pi*1.0e3*t)
+    square = where(sin(2*pi*500*t) >= 0, 5.0, 0.0)
+    ramp = clip((t % 2.0e-3)/1.0e-4, 0, 1)   # 0 -> 1 in 100 us, every 2 ms
+    resD = measureBatch([sine, square], xincr)
+    assert allclose(resD['FREQ'], (1.0e3, 500.0), rtol=1e-3)
+    assert allclose(resD['PK2P'], (4.0, 5.0), rtol=1e-3)
+    assert allclose(resD['MEAN'][0], 0.0, atol=1e-3)
+    assert allclose(resD['CRMS'], (2.0**0.5, 5.0/2**0.5), rtol=1e-2)
+    assert allclose(resD['PWID'][1], 1.0e-3, rtol=1e-2) and allclose(resD['NWID'][1], 1.0e-3, rtol=1e-2)
+    rise = measureBatch(ramp, xincr, ('RISE',))['RISE'][0]
+    assert allclose(rise, 0.8e-4, rtol=1e-2), rise
+    lag = measureBatch(2.0*sin(2*pi*1.0e3*t - pi/2), xincr, ('PHAS',), refV=sine)['PHAS'][0]
+    assert allclose(lag, 90.0, atol=1.0), lag
+    # no whole period in the record: CRMS is the RMS of all of it, DC included
+    step = where(t >= 0, 5.0, 0.0)
+    crms = measureBatch(step, xincr, ('CRMS',))['CRMS'][0]
+    assert allclose(crms, (step*step).mean()**0.5), crms
+    # noise wiggling around the mid level makes no edges: 4 Vpp 500 Hz sine, 40 and 100 mV rms of noise
+    rs = RandomState(3)
+    for noise in (0.04, 0.1):
+        V = [ 2.0*sin(2*pi*500*t) + noise*rs.standard_normal(len(t)) for i in range(20) ]
+        resD = measureBatch(V, xincr, ('FREQ', 'PWID', 'NWID', 'CRMS'))
+        assert allclose(resD['FREQ'], 500.0, rtol=0.02), (noise, resD['FREQ'])
+        assert allclose(resD['PWID'], 1.0e-3, rtol=0.04) and allclose(resD['NWID'], 1.0e-3, rtol=0.04), noise
+        assert allclose(resD['CRMS'], 2.0**0.5, rtol=0.02), (noise, resD['CRMS'])
+
+def checkEnvelope():
+    # min/max per run keeps a one sample glitch, runs cover every point when cols doesn't divide the length,
+    # and plotTrace() decimates only traces longer than twice the pixel columns
+    from matplotlib import pyplot
+    pyplot.switch_backend('Agg')
+    from plotter import envelope, ScopeDisplay
+    rs = RandomState(2)
+    Y = 0.1*rs.standard_normal((3, 1001))
+    Y[1, 517] = 5.0
+    Y[2, 1000] = -5.0
+    lo, hi, mid = envelope(Y, 300)
+    assert lo.shape == hi.shape == (3, 300) and len(mid) == 300
+    edgeL = [ (i*1001)//300 for i in range(301) ]
+    for i in range(300):
+        run = Y[:, edgeL[i]:edgeL[i+1]]
+        assert array_equal(lo[:, i], run.min(1)) and array_equal(hi[:, i], run.max(1))
+        assert edgeL[i] <= mid[i] < edgeL[i+1]
+    assert hi[1].max() == 5.0 and lo[2, -1] == -5.0
+    lo, hi, mid = envelope(Y[0], 1001)
+    assert lo.shape == (1, 1001) and array_equal(lo, hi) and array_equal(mid, arange(1001))
+    scope = _quietScope()
+    scope.acquire({1: ()})
+    disp = ScopeDisplay(scope, 'env', disp=False, save=False)
+    disp.pixelColumns = lambda ax=None: 100
+    pyplot.figure('env')
+    x = arange(201.0)
+    assert len(disp.plotTrace(x[:200], Y[1, :200])[0].get_ydata()) == 200
+    line = disp.plotTrace(x, Y[1, 400:601])[0]
+    assert len(line.get_ydata()) == 200 and line.get_ydata().max() == 5.0
+    disp.plotOverlay(1, Y[:, 400:601], x=x, newfig=False)
+    band = pyplot.gca().collections[-1].get_paths()[0].vertices[:, 1]
+    assert band.max() == 5.0 and len(pyplot.gca().lines[-1].get_ydata()) == 200
+    pyplot.close('all')
+
+def checkHeadlessDisplay():
+    # display(backend='Agg') in a fresh process loads no other backend (Tk needs a display, or isn't there)
+    import subprocess
+    code = ("import sys; from testscope import DummyScope; scope = DummyScope(); scope.acquire({1: ()}); "
+            "scope.display(disp=False, save=False, backend='Agg'); print sorted(m for m in sys.modules if 'tkinter' in m.lower())")
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.strip().splitlines()[-1] == '[]', out
+
+def checkLiveDisplay():
+    # the live view draws what scopeView draws, whatever the encoding
+    from matplotlib import pyplot
+    pyplot.switch_backend('Agg')
+    from plotter import LiveDisplay
+    scope = _quietScope()
+    scope.cmd('DATA:ENCDG RPBINARY')
+    scope.acquire({1: (), 2: ()})
+    live = LiveDisplay(scope, (1, 2))
+    for recL in scope.sequence((1, 2), 2):  # records without a voltsdiv
+        live.update( dict( (rec.chN, rec.wfm) for rec in recL ) )
+        for rec in recL:
+            assert allclose(live.lineD[rec.chN].get_ydata(), scope.getChannel(rec.chN).trace_undisplaced)
+    pyplot.close(live.fig)
+
+def checkMeasLog():
+    # windowed and whole run statistics against numpy on what went in, through a wrapping ring
+    from measlog import MeasLog
+    rs = RandomState(1)
+    log = MeasLog([(1, 'FREQ'), (2, 'MEAN')], capacity=50, windowL=(10, 50))
+    valA = rs.standard_normal((120, 2))
+    valA[::7, 1] = mNAN  # missing readings
+    for i, (f, m) in enumerate(valA):
+        log.append({1: {'FREQ': f}, 2: {'MEAN': m}}, t=i)
+    valA[valA == mNAN] = float('nan')
+    for w, win in ((10, valA[-10:]), (50, valA[-50:]), (None, valA)):
+        statD = log.stats(w)
+        for i, key in enumerate(log.keyL):
+            st = statD[key]
+            assert allclose(st['mean'], nanmean(win[:, i])), (w, key)
+            assert allclose(st['std'], nanstd(win[:, i], ddof=1)), (w, key)
+            assert st['min'] == nanmin(win[:, i]) and st['max'] == nanmax(win[:, i]), (w, key)
+    # measLoop() into a log of our own prints that log's window, and refuses one it doesn't have
+    from StringIO import StringIO
+    scope = DummyScope()
+    scope._measCtl.slotSettle = 0.0
+    log = MeasLog([(1, 'FREQ')], windowL=(10,))
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        assert scope.measLoop({1: ('FREQ',)}, n=2, log=log, every=0) is log and log.n == 2
+        out = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    assert out.count('\n'.join(log.format(10))) == 1, out
+    try:
+        scope.measLoop({1: ('FREQ',)}, n=1, log=log, window=100)
+    except ValueError:
+        assert log.n == 2
+    else:
+        raise AssertionError('measLoop took a window the log lacks')
+
+def checkMeasSlots():
+    # acquire() reads its measurements through IMMed in one query, with no wait for the display; slots are
+    # read only once the display has refreshed them after an acquisition or the last read, and a reset of the
+    # instrument's settings takes our slot configuration with it
+    scope = DummyScope()
+    scope._measCtl.slotSettle = 0.05
+    doneL, readL, immL = [], [], []
+    message, waitAcq = scope.sim.message, scope.waitAcq
+    def logMessage(msg):
+        if 'MEAS' in msg.upper() and 'VAL?' in msg.upper():
+            (immL if 'IMM' in msg.upper() else readL).append(time())
+        return message(msg)
+    def logWait(*args, **kwD):
+        dt = waitAcq(*args, **kwD)
+        doneL.append(time())
+        return dt
+    scope.sim.message, scope.waitAcq = logMessage, logWait
+    scope.acquire({1: ('FREQ', 'PK2P'), 2: ('CRMS',)})
+    assert not readL and len(immL) == 1 and immL[0]-doneL[0] < 0.05
+    measD = scope.sim.measure
+    assert allclose(scope.getChannel(1)._msmnt.freq, measD('FREQ', 'CH1'), rtol=1e-3)
+    assert allclose(scope.getChannel(2)._msmnt.crms, measD('CRMS', 'CH2'), rtol=1e-3)
+    scope.measLoop({1: ('FREQ',)}, n=3, every=None)
+    assert len(readL) == 3 and readL[0]-doneL[0] >= 0.05 and min(b-a for a, b in zip(readL, readL[1:])) >= 0.05
+    valD = scope.acqMeas({1: ('FREQ', 'PK2P')})
+    scope.cmd('*RST')
+    assert mNAN not in scope.acqMeas({1: ('FREQ', 'PK2P')})[1].values()
+    assert allclose(scope.acqMeas({1: ('FREQ', 'PK2P')})[1]['FREQ'], valD[1]['FREQ'], rtol=1e-3)
+    # what doesn't fit in the slots comes back in one IMMed query
+    scope.setAcqState('STOP')
+    del immL[:], readL[:]
+    typT = ('FREQ', 'MEAN', 'PERI', 'PHAS', 'PK2P', 'CRMS', 'MINI', 'MAXI')
+    valD = scope.acqMeas({1: typT})
+    assert len(readL) == 1 and len(immL) == 1 and sorted(valD[1]) == sorted(typT)
+    assert allclose(valD[1]['MAXI'], scope.sim.measure('MAXI', 'CH1'), rtol=1e-3)
+
+def checkMetrics():
+    # a profiled CURVE? takes as long as reading its data block
+    scope = DummyScope(link=(0.0005, 1.0e5))
+    with scope.profile() as m:
+        scope.acquire({1: ()})
+    e = m.snapshot()['mnemonics']['CURV?']
+    assert e['msgs'] == 1 and e['in'] > scope.recordLength and e['time'] >= e['io'] > 0.02, e
+
+def checkReport():
+    # renderCaptures() here and on a pool, of stored captures and of TraceRecords in memory: one file per
+    # figure per capture, paths in capture order
+    from scopereport import renderCaptures
+    tmpDir = tempfile.mkdtemp()
+    try:
+        scope = _quietScope()
+        scope.storePath = os.path.join(tmpDir, 'scope.dat')
+        for i in range(3):
+            scope.acquire({1: ('FREQ',), 2: ()})
+            scope.dump()
+        scope.closeStore()
+        memL = [ recL for recL in scope.sequence((1, 3), 3) ]
+        for name, captures, path in (('stored', [0, 1, 2], scope.storePath), ('memory', memL, None)):
+            nameLL = []
+            for processes in (1, 2):
+                outDir = os.path.join(tmpDir, '%s%d'%(name, processes))
+                pathLL = renderCaptures(captures, path, outDir, ('png', 'svg'), processes=processes, chunksize=1)
+                assert len(pathLL) == 3 and all(len(pathL) == 3*2 for pathL in pathLL), (name, processes)
+                for capN, pathL in enumerate(pathLL):
+                    assert all(p.startswith(outDir) and os.path.getsize(p) > 0 for p in pathL)
+                    assert all(p.endswith('-%d.png'%capN) or p.endswith('-%d.svg'%capN) for p in pathL), pathL
+                assert sorted(os.listdir(outDir)) == sorted(os.path.basename(p) for pathL in pathLL for p in pathL)
+                nameLL.append([ map(os.path.basename, pathL) for pathL in pathLL ])
+            assert nameLL[0] == nameLL[1], name
+    finally:
+        shutil.rmtree(tmpDir)
+
+def checkSerialNegotiate():
+    # negotiate() ends with both ends at the fastest common rate, hard flagging on both ends where the cable
+    # has RTS/CTS and off on both where it hasn't, without hanging on the way
+    for cable in (True, False):
+        for maxBaud, rates, baud in ((None, SimSerial.BAUDRATES, 19200), (4800, SimSerial.BAUDRATES, 4800),
+                                     (None, (4800, 9600), 9600)):
+            sim = SimInstrument()
+            port = SimSerial(sim, cableRTSCTS=cable)
+            port.BAUDRATES = rates
+            scope = SerialScope(port)
+            assert scope.negotiate(maxBaud) > 0, (cable, maxBaud)
+            assert port.baudrate == sim.setD['RS232:BAUD'] == scope._baud == baud, (cable, maxBaud, port.baudrate)
+            assert port.rtscts == sim.setD['RS232:HARDFLAGGING'] == cable, (cable, maxBaud)
+            assert port.timeout is None and port.writeTimeout is None
+            assert scope.query_val('*IDN?') and sim.unknownL == []
+
+def checkSequence():
+    # captures come decoded, and once the loop has moved on the records kept hold only their codes
+    scope = _quietScope()
+    scope.acquire({1: ()})
+    ref = scope.getChannel(1).trace.copy()
+    keptL = []
+    for recL in scope.sequence((1, 2), 3):
+        assert all(rec.wfm._volts is not None for rec in recL)
+        keptL.append(recL)
+    for recL in scope.sequence((1, 2)):
+        keptL.append(recL)
+        break
+    for recL in keptL:
+        assert all(rec.wfm._volts is None and rec.wfm._div is None for rec in recL)
+    assert allclose(keptL[0][0].trace(), ref)
+
+def checkShadow():
+    # apply() of a shadow() sends only the settings changed since, never the trigger STATE
+    scope = DummyScope()
+    scope.snapshot()
+    step = scope.shadow()
+    scope.acquire({1: ()})
+    scope.getTrigger(forceAcq=True)
+    assert scope.apply(step) == []
+    scope.cmd('CH1:SCALE 0.5;:TRIG:MAIN:LEVEL 0.3;:HOR:MAIN:SCA 1.0E-3')
+    assert sorted(scope.apply(step)) == sorted([(1, 'SCA', 1.0), ('TRIG', 'LEVEL', 0.0), ('HOR', 'HOR:MAIN:SCA', 5.0e-4)])
+    assert scope.sim.unknownL == []
+    scope.snapshot()
+    shD = scope.shadow()
+    del shD['TRIG']['STATE'], step['TRIG']['STATE']
+    assert shD == step
+    # keywords differing by a number suffix are different settings, short and long forms the same one
+    assert sameSetting('NORM', 'NORMAL') and sameSetting('ext', 'EXT') and sameSetting('0.5', 5.0e-1)
+    assert not sameSetting('EXT', 'EXT5') and not sameSetting('EXT10', 'EXT') and not sameSetting('EXT5', 'EXT10')
+    for sou in ('EXT', 'EXT5', 'EXT10', 'EXT', 'CH1'):
+        step['TRIG']['EDGE:SOU'] = sou
+        assert scope.apply(step) == [('TRIG', 'EDGE:SOU', sou)] and scope.sim.setD['TRIGGER:MAIN:EDGE:SOURCE'] == sou
+
+def checkStream():
+    # whole captures even when the ring drops, measurements of the capture itself, scope back in RUN after
+    from itertools import islice
+    scope = DummyScope()
+    st = scope.stream({1: ('PK2P',), 2: ()}, capacity=3, policy='DROP')
+    sleep(0.2)
+    recL = list(islice(st, 12))
+    st.close()
+    assert st.dropped > 0
+    for i in range(0, len(recL), 2):
+        assert (recL[i].chN, recL[i+1].chN) == (1, 2) and recL[i].capN == recL[i+1].capN
+        assert allclose(recL[i].measD['PK2P'], recL[i].trace().ptp())
+    assert _nodeMatch(scope.sim.setD['ACQUIRE:STOPAFTER'], 'RUNSTOP') and scope.sim._running
+    # triggers further apart than acqTimeout are gaps, not the end; close() doesn't wait out a trigger
+    scope.sim.trigPeriod, scope.acqTimeout = 0.3, 0.1
+    st = scope.stream({1: ()})
+    recL = list(islice(st, 2))
+    assert st.gaps >= 2 and st._excInfo is None
+    sleep(0.1)
+    t0 = time()
+    st.close()
+    assert time()-t0 < 0.2 and st._excInfo is None
+
+def checkTraceStore():
+    # dump() then load() gives back the codes, preamble and measurements, also across chunks of several captures
+    from tracestore import TraceStore, idxDtype
+    tmpDir = tempfile.mkdtemp()
+    try:
+        scope = DummyScope()
+        scope.storePath = os.path.join(tmpDir, 'scope.dat')
+        TraceStore.chunkRecords, chunkRecords = 4, TraceStore.chunkRecords
+        keptL = []
+        try:
+            for i in range(5):
+                scope.acquire({1: ('FREQ',), 2: ('MEAN',)}, window=(1, 1000+i))
+                keptL.append([ (chN, scope.getChannel(chN).codes.copy(), dict(scope.getChannel(chN).wfmD),
+                                scope.getChannel(chN)._msmnt.freq if chN == 1 else scope.getChannel(chN)._msmnt.mean)
+                               for chN in (1, 2) ])
+                sweepStr = scope.sweepStr
+                assert scope.dump() == i
+            # dump() leaves the records to fill whole chunks, closing writes the rest
+            assert os.path.getsize(scope.storePath + '.idx') == 8*idxDtype.itemsize
+            scope.closeStore()
+        finally:
+            TraceStore.chunkRecords = chunkRecords
+        store = TraceStore(scope.storePath, 'r')
+        assert len(store) == 10 and len(set(store.index['chunk'].tolist())) == 3
+        store.close()
+        for capN, keep in enumerate(keptL):
+            recL = scope.load(capN)
+            assert scope.sweepStr == sweepStr, (scope.sweepStr, sweepStr)
+            for (chN, codes, wfmD, val), rec in zip(keep, recL):
+                chan = scope.getChannel(chN)
+                assert rec.capN == capN and rec.chN == chN
+                assert array_equal(chan.codes, codes) and chan.wfmD == wfmD
+                assert rec.measD.values() == [val]
+        scope.closeStore()
+        # an index row cut short by a crash is dropped when the store is opened to append again
+        with open(scope.storePath + '.idx', 'ab') as fp:
+            fp.write('\0'*10)
+        scope.acquire({1: ('FREQ',), 2: ('MEAN',)})
+        assert scope.dump() == 5
+        scope.closeStore()
+        store = TraceStore(scope.storePath, 'r')
+        assert store.between() == range(6) and [rec.chN for rec in store.capture(5)] == [1, 2]
+        store.close()
+    finally:
+        shutil.rmtree(tmpDir)
+
+def runChecks():
+    checkL = sorted( (name, func) for name, func in globals().items() if name.startswith('check') )
+    for name, func in checkL:
+        func()
+        print '%-20s ok'%name
+    return len(checkL)
+
 if __name__=='__main__':
-    tds2024 = DummyScope(port=None, debug=True)
+    print '%d checks passed'%runChecks()
+
+    tds2024 = DummyScope(debug='-v' in sys.argv)
     mT = ('FALL', 'RISE', 'PK2P', 'CRMS')
-    tds2024.setTrigger(level=4.56, holdo=None, mode='NORMAL', typ='EDGE', trigD={'SOU':'CH3'})
+    tds2024.setTrigger(level=0.5, holdo=None, mode='NORMAL', typ='EDGE', trigD={'SOU':'CH1'})
     print tds2024.getTrigger(forceAcq=True)
     acqD =  {3:mT, 2: mT, 1: mT}
     tds2024.acquire(acqD )
-    pl=ScopeDisplay(tds2024)
+    # on screen with a display, written to files without one
+    interactive = bool(os.environ.get('DISPLAY'))
+    pl=tds2024.display('sim', disp=False, save=False, backend='TkAgg' if interactive else 'Agg')
     pl.plotChannel(3)
     pl.plotChannel(2, scopeView=False)
     pl.plotChannel(1, scopeView=False)    
-    pl.plotAll()
-    pl.annotate_plots( )
-    pl.show()
-    
+    pl.plotAll((1,2,3))
+    if interactive:
+        pl.show()
+    else:
+        print '\n'.join(pl.saveFigures(tempfile.gettempdir()))
@@ -0,0 +1,153 @@
+# traceaccum.py
+# host side trace averaging: per point mean, variance, min and max over any number of captures, in constant memory
+#
+# the scope's own ACQuire:MODe AVErage stops at 128 acquisitions and gives back the mean only. here every point of
+# the record gets Welford updates, vectorized over the record, into float64 buffers made once; an exponential
+# moving average can run alongside. traces are accumulated as raw curve codes and scaled to volts when read,
+# which is exact while the preamble stays the same: when it changes (V/div, sweep, window, ...) the accumulator
+# hands its state to onReset and starts over
+
+from numpy import asarray, atleast_2d, empty, zeros, subtract, multiply, minimum, maximum, sqrt, nan, float64
+
+class TraceAccumulator(object):
+    """
+    Running statistics of a channel's traces, point by point, e.g.
+
+        acc = TraceAccumulator(ema=0.05, onReset=lambda acc: saved.append(acc.stats()))
+        for recL in scope.sequence((1,), 10000):
+            acc.add(recL[0])
+        acc.mean, acc.std, acc.min, acc.max, acc.ema   # volts, one value per point
+
+    add() takes TraceRecords (stream(), sequence(), TraceStore), Channels after acquire(), Waveforms, or plain
+    arrays (taken as volts). ema: weight of the newest trace in the exponential moving average, None for none.
+    """
+    def __init__(self, points=None, ema=None, onReset=None):
+        self.alpha = ema
+        self.onReset = onReset  # called with the accumulator before a preamble change clears it
+        self.resets = 0
+        self.key = None
+        self.n = 0
+        self._alloc(points)
+
+    def _alloc(self, points):
+        # the buffers, in codes; scratch holds the per trace temporaries
+        self.points = points
+        if points is None: return
+        self._mean = zeros(points)
+        self._m2 = zeros(points)
+        self._min = empty(points)
+        self._max = empty(points)
+        self._ema = empty(points) if self.alpha else None
+        self._d = empty(points)
+        self._tmp = empty(points)
+
+    @staticmethod
+    def _source(src):
+        # (codes, (yoff, ymult, yzero), settings key) of whatever add() was given
+        wfm = getattr(src, 'wfm', src)
+        if not hasattr(wfm, 'codes'):
+            y = asarray(src, dtype=float64)
+            return y, (0.0, 1.0, 0.0), (len(y),)
+        scale = (wfm.yoff, wfm.ymult, wfm.yzero)
+        return wfm.codes, scale, (len(wfm), wfm.codes.dtype.str, wfm.start, wfm.xincr, wfm.xzero) + scale
+
+    def reset(self):
+        # forget everything, the buffers stay
+        self.n = 0
+        self.key = None
+        if self.points is not None:
+            self._mean[:] = 0.0
+            self._m2[:] = 0.0
+
+    def _check(self, key, scale, points):
+        # a trace taken with other settings than the ones accumulated so far restarts the statistics
+        if key == self.key: return
+        if self.n:
+            if self.onReset: self.onReset(self)
+            self.resets += 1
+        if points != self.points: self._alloc(points)
+        self.reset()
+        self.key = key
+        self.scale = scale
+
+    def add(self, src):
+        x, scale, key = self._source(src)
+        self._check(key, scale, len(x))
+        mean, d, tmp = self._mean, self._d, self._tmp
+        self.n += 1
+        if self.n == 1:
+            self._min[:] = x
+            self._max[:] = x
+            if self.alpha: self._ema[:] = x
+        else:
+            minimum(self._min, x, out=self._min)
+            maximum(self._max, x, out=self._max)
+            if self.alpha:
+                subtract(x, self._ema, out=tmp)
+                tmp *= self.alpha
+                self._ema += tmp
+        subtract(x, mean, out=d)      # x - mean
+        multiply(d, 1.0/self.n, out=tmp)
+        mean += tmp                   # mean += (x - mean)/n
+        subtract(x, mean, out=tmp)
+        tmp *= d
+        self._m2 += tmp               # m2 += (x - old mean)*(x - new mean)
+
+    def addBatch(self, srcL):
+        # several traces at once (all with the same settings): their stats merged in (Chan et al.), the EMA
+        # stepped through them in order
+        srcL = list(srcL)
+        if not srcL: return
+        x, scale, key = self._source(srcL[0])
+        self._check(key, scale, len(x))
+        Y = atleast_2d( asarray([self._source(src)[0] for src in srcL], dtype=float64) )
+        k = len(Y)
+        bMean = Y.mean(0)
+        bM2 = ((Y - bMean)**2).sum(0)
+        if self.n == 0:
+            self._mean[:] = bMean
+            self._m2[:] = bM2
+            self._min[:] = Y.min(0)
+            self._max[:] = Y.max(0)
+        else:
+            n = float(self.n + k)
+            d = bMean - self._mean
+            self._mean += d*(k/n)
+            self._m2 += bM2 + d*d*(self.n*k/n)
+            minimum(self._min, Y.min(0), out=self._min)
+            maximum(self._max, Y.max(0), out=self._max)
+        if self.alpha:
+            i0 = 0
+            if self.n == 0:
+                self._ema[:] = Y[0]
+                i0 = 1
+            for y in Y[i0:]:
+                self._ema += self.alpha*(y - self._ema)
+        self.n += k
+
+    # -- statistics, in volts, new arrays
+    def _volts(self, a):
+        if self.n == 0: return None
+        yoff, ymult, yzero = self.scale
+        return (a - yoff)*ymult + yzero
+
+    mean = property(lambda self: self._volts(self._mean))
+    min = property(lambda self: self._volts(self._min))
+    max = property(lambda self: self._volts(self._max))
+    ema = property(lambda self: self._volts(self._ema) if self.alpha else None)
+
+    @property
+    def var(self):
+        # sample variance per point, NaN below 2 traces
+        if self.n == 0: return None
+        if self.n < 2: return zeros(self.points) + nan
+        return self._m2*(self.scale[1]**2/(self.n - 1))
+
+    @property
+    def std(self):
+        var = self.var
+        return None if var is None else sqrt(var)
+
+    def stats(self):
+        # everything at once: {'n', 'mean', 'std', 'min', 'max', 'ema'}
+        return {'n': self.n, 'mean': self.mean, 'std': self.std, 'min': self.min, 'max': self.max, 'ema': self.ema}
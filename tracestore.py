@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# tracestore.py
+# append-only on-disk archive of scope captures, behind TektronixScope.dump/load
+#
+# two files:
+#   <path>      chunks of records, each: 'TKS1' nrec metaLen dataLen, zlib(json metadata), zlib(raw curve codes)
+#               metadata is per record (channel, dtype, measurements, ...) plus the distinct preambles and
+#               trigger settings of the chunk, so a long run of identical settings is stored once per chunk
+#   <path>.idx  one fixed size row per record (t, capN, chN, rec within chunk, chunk offset), searched through
+#               numpy.memmap, so finding a capture reads neither the whole index nor the data file
+#
+# a chunk is written and flushed before its index rows: a crash loses at most the records after the last
+# complete index row, and those still waiting in memory for their chunk to fill (flush() writes them early). both are read through memory maps, and only the chunks asked for get decompressed
+
+import os
+import json
+import zlib
+import mmap
+from struct import pack, unpack_from
+from collections import OrderedDict
+from numpy import array, dtype, frombuffer, memmap, zeros, searchsorted
+
+from tekscope import TraceRecord
+
+idxDtype = dtype([('t', '<f8'), ('capN', '<i8'), ('chN', '<i2'), ('rec', '<i2'), ('chunk', '<i8')])
+
+def _asStr(d):
+    # json hands back unicode, the preambles and settings we stored were plain str
+    return dict( (str(key), str(val) if isinstance(val, unicode) else val) for key, val in d.items() )
+
+class TraceStore(object):
+    """
+    Captures (lists of TraceRecords, one per channel) appended to a chunked, compressed file, found again by
+    capture number or time.
+
+        with TraceStore('soak.dat') as store:
+            for recL in scope.sequence((1, 2)):
+                store.appendCapture(recL, scope.getTrigger(False))
+
+        store = TraceStore('soak.dat', 'r')
+        capL = store.between(t0, t1)
+        recL = store.capture(capL[0])
+
+    Records are buffered until chunkRecords of them make a chunk, flush() writes a short one.
+    Capture numbers are the store's own, counting from 0 over the whole archive.
+    """
+    magic = 'TKS1'
+    hdrFmt = '<4sIII'
+    hdrLen = 16
+    chunkRecords = 256
+    compressLevel = 1  # the codes are noisy, higher levels buy little and cost a lot of time
+    cacheChunks = 4    # decompressed chunks kept around for reads
+
+    def __init__(self, path, mode='a'):
+        if mode not in ('r', 'a'): raise ValueError('Not a store mode: %s'%mode)
+        self.path = path
+        self.idxPath = path + '.idx'
+        self.mode = mode
+        if mode == 'a':
+            self._dfp = open(self.path, 'ab')
+            self._ifp = open(self.idxPath, 'ab')
+            # a row cut short by a crash goes, or every row appended after it would be read shifted
+            size = os.path.getsize(self.idxPath)
+            if size % idxDtype.itemsize: self._ifp.truncate(size - size % idxDtype.itemsize)
+        elif not os.path.exists(self.idxPath):
+            raise IOError('No trace store index %s'%self.idxPath)
+        self._pendL = []   # (capN, record, trigD) waiting for the next chunk
+        self._map = None   # mmap of the data file
+        self._idx = None   # memmap of the index
+        self._nIdx = 0
+        self._cacheD = OrderedDict()
+        idx = self.index
+        self.nextCap = int(idx['capN'][-1])+1 if len(idx) else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    # -- writing
+    def appendCapture(self, recL, trigD=None):
+        # returns the capture number given to the records
+        if self.mode != 'a': raise IOError('Trace store %s is read only'%self.path)
+        capN = self.nextCap
+        self.nextCap += 1
+        for rec in recL:
+            self._pendL.append( (capN, rec, trigD) )
+        if len(self._pendL) >= self.chunkRecords: self.flush()
+        return capN
+
+    def flush(self):
+        if not self._pendL: return
+        pendL, self._pendL = self._pendL, []
+        wfmL, trigL, recL, rowL, blockL = [], [], [], [], []
+        wfmIdxD, trigIdxD = {}, {}
+        off = 0
+        for i, (capN, rec, trigD) in enumerate(pendL):
+            wfmIdx = self._intern(rec.wfmD, wfmL, wfmIdxD)
+            if trigD is None: trigD = rec.trigD
+            trigIdx = self._intern(trigD, trigL, trigIdxD) if trigD is not None else -1
+            codes = rec.codes
+            measL = [ [typ, float(val)] for typ, val in rec.measD.items() ]
+            recL.append( [rec.chN, off, codes.nbytes, codes.dtype.str, wfmIdx, trigIdx, rec.voltsdiv, measL] )
+            blockL.append(codes.tostring())
+            off += codes.nbytes
+            rowL.append( (rec.t, capN, rec.chN, i) )
+        zmeta = zlib.compress(json.dumps({'recL': recL, 'wfmL': wfmL, 'trigL': trigL}), self.compressLevel)
+        zdata = zlib.compress(''.join(blockL), self.compressLevel)
+
+        self._dfp.seek(0, os.SEEK_END)
+        chunk = self._dfp.tell()
+        self._dfp.write(pack(self.hdrFmt, self.magic, len(recL), len(zmeta), len(zdata)) + zmeta + zdata)
+        self._dfp.flush()
+        idx = array([ (t, capN, chN, i, chunk) for t, capN, chN, i in rowL ], dtype=idxDtype)
+        self._ifp.write(idx.tostring())
+        self._ifp.flush()
+
+    @staticmethod
+    def _intern(d, valL, idxD):
+        # index of d in valL, appended if new; dicts are compared by their JSON
+        key = json.dumps(d, sort_keys=True)
+        if key not in idxD:
+            idxD[key] = len(valL)
+            valL.append(d)
+        return idxD[key]
+
+    def close(self):
+        if self.mode == 'a':
+            self.flush()
+            self._dfp.close()
+            self._ifp.close()
+        if self._map is not None: self._map.close()
+        self._map = self._idx = None
+        self._cacheD.clear()
+
+    # -- reading
+    @property
+    def index(self):
+        # the index rows, a memmap remapped when the file has grown; idxDtype
+        n = os.path.getsize(self.idxPath)//idxDtype.itemsize if os.path.exists(self.idxPath) else 0
+        if n != self._nIdx or self._idx is None:
+            self._idx = memmap(self.idxPath, dtype=idxDtype, mode='r', shape=(n,)) if n else zeros(0, dtype=idxDtype)
+            self._nIdx = n
+        return self._idx
+
+    def __len__(self):
+        # records written, captures are counted by nextCap
+        return len(self.index)
+
+    def rows(self, capN):
+        # index row numbers of a capture, negative capN counts from the end
+        if capN < 0: capN += self.nextCap
+        capA = self.index['capN']
+        return range(searchsorted(capA, capN, 'left'), searchsorted(capA, capN, 'right'))
+
+    def between(self, t0=None, t1=None):
+        # capture numbers taken in t0 <= t < t1 (host time, as in TraceRecord.t)
+        idx = self.index
+        tA = idx['t']
+        lo = searchsorted(tA, t0, 'left') if t0 is not None else 0
+        hi = searchsorted(tA, t1, 'left') if t1 is not None else len(tA)
+        return sorted(set(idx['capN'][lo:hi].tolist()))
+
+    def capture(self, capN):
+        # the TraceRecords of one capture
+        recL = [ self.record(i) for i in self.rows(capN) ]
+        if not recL: raise IndexError('No capture %d in %s'%(capN, self.path))
+        return recL
+
+    def record(self, i):
+        row = self.index[i]
+        metaD, data = self._chunk(int(row['chunk']))
+        chN, off, nbytes, dt, wfmIdx, trigIdx, voltsdiv, measL = metaD['recL'][int(row['rec'])]
+        dt = dtype(str(dt))
+        rec = TraceRecord(float(row['t']), int(row['capN']), chN, frombuffer(data, dtype=dt, count=nbytes//dt.itemsize, offset=off),
+                          metaD['wfmL'][wfmIdx], OrderedDict( (str(typ), val) for typ, val in measL ), voltsdiv, metaD['trigL'][trigIdx] if trigIdx >= 0 else None)
+        return rec
+
+    def _chunk(self, chunk):
+        # (metadata, codes) of the chunk at byte offset chunk, through the cache
+        if chunk in self._cacheD:
+            val = self._cacheD.pop(chunk)
+        else:
+            if self._map is None or len(self._map) < chunk+self.hdrLen:
+                self._remap()
+            magic, nrec, metaLen, dataLen = unpack_from(self.hdrFmt, self._map, chunk)
+            if magic != self.magic: raise ValueError('Bad trace store chunk at %d in %s'%(chunk, self.path))
+            if len(self._map) < chunk+self.hdrLen+metaLen+dataLen:
+                self._remap()
+            start = chunk+self.hdrLen
+            metaD = json.loads(zlib.decompress(self._map[start:start+metaLen]), object_hook=_asStr)
+            data = zlib.decompress(self._map[start+metaLen:start+metaLen+dataLen])
+            val = (metaD, data)
+            if len(self._cacheD) >= self.cacheChunks: self._cacheD.popitem(last=False)
+        self._cacheD[chunk] = val
+        return val
+
+    def _remap(self):
+        if self._map is not None: self._map.close()
+        with open(self.path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)